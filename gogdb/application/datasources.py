@@ -2,13 +2,25 @@ import quart
 import aiosqlite
 
 import gogdb.core.storage as storage
+from gogdb.core.loadcache import LoadCache
 
 
 
+# Shared by all requests of this process
+load_cache = None
+
+def get_load_cache():
+    global load_cache
+    cache_size = quart.current_app.config.get("STORAGE_CACHE_SIZE", 0)
+    if load_cache is None and cache_size > 0:
+        storage_path = quart.current_app.config["STORAGE_PATH"]
+        load_cache = LoadCache(cache_size, storage.Storage(storage_path).path_generation())
+    return load_cache
+
 def get_storagedb():
     if "storagedb" not in quart.g:
-        storage_path = quart.current_app.config["STORAGE_PATH"]
-        quart.g.storagedb = storage.Storage(storage_path)
+        quart.g.storagedb = storage.Storage.from_config(
+            quart.current_app.config, load_cache=get_load_cache())
 
     return quart.g.storagedb
 
@@ -29,5 +41,11 @@ async def teardown_indexdb(exception=None):
     if indexdb is not None:
         await indexdb.close()
 
+async def teardown_storagedb(exception=None):
+    storagedb = quart.g.pop("storagedb", None)
+    if storagedb is not None:
+        await storagedb.close()
+
 def add_teardown(app):
     app.teardown_appcontext(teardown_indexdb)
+    app.teardown_appcontext(teardown_storagedb)
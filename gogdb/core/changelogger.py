@@ -2,9 +2,44 @@ import copy
 
 import gogdb.core.model as model
 
+DOWNLOAD_TYPES = ["bonus", "installer", "langpack", "patch"]
+
+def download_key(download):
+    """Fields compared for changes, files are stripped from change records and not compared"""
+    if isinstance(download, model.BonusDownload):
+        return (download.name, download.total_size, download.bonus_type, download.count)
+    # Languages are only compared on the language codes, the name does not matter
+    return (download.name, download.total_size, download.os, download.version, download.language.code)
+
+def downloads_fingerprint(downloads):
+    return tuple((dl.unique_id, download_key(dl)) for dl in downloads)
+
+class ProductSnapshot:
+    """
+    The state of a product before it is updated, as far as the Changelogger compares it
+
+    Extraction assigns new values and download lists to the product, so keeping
+    references to the old ones is enough. Builds are updated in place, only their
+    ids are kept.
+    """
+    def __init__(self, prod):
+        self.properties = vars(prod).copy()
+        self.dl_fingerprints = {
+            name: downloads_fingerprint(getattr(prod, "dl_" + name)) for name in DOWNLOAD_TYPES
+        }
+        self.build_ids = set(build.id for build in prod.builds)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["properties"][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
 class Changelogger:
     def __init__(self, prod_new, prod_old, timestamp):
         self.prod_new = prod_new
+        if prod_old is not None and not isinstance(prod_old, ProductSnapshot):
+            prod_old = ProductSnapshot(prod_old)
         self.prod_old = prod_old
         self.timestamp = timestamp
         self.entries = []
@@ -41,6 +76,9 @@ class Changelogger:
     def downloads(self, name):
         downloads_new = getattr(self.prod_new, "dl_" + name)
         downloads_old = getattr(self.prod_old, "dl_" + name)
+        # Most updates don't change any download of a type
+        if downloads_fingerprint(downloads_new) == self.prod_old.dl_fingerprints[name]:
+            return
 
         dl_map_new = {dl.unique_id: dl for dl in downloads_new}
         dl_map_old = {dl.unique_id: dl for dl in downloads_old}
@@ -52,11 +90,11 @@ class Changelogger:
             dl_rec = model.DownloadRecord(dl_type=name)
 
             if in_new and in_old:
+                if download_key(dl_map_new[dl_id]) == download_key(dl_map_old[dl_id]):
+                    continue
                 dl_new = self.strip_download(dl_map_new[dl_id])
                 dl_old = self.strip_download(dl_map_old[dl_id])
                 action = "change"
-                if dl_new.is_same(dl_old):
-                    continue
             elif in_new:
                 dl_new = self.strip_download(dl_map_new[dl_id])
                 dl_old = None
@@ -85,10 +123,9 @@ class Changelogger:
 
     def builds(self):
         builds_new = self.prod_new.builds
-        builds_old = self.prod_old.builds
 
         build_ids_new = set(build.id for build in builds_new)
-        build_ids_old = set(build.id for build in builds_old)
+        build_ids_old = self.prod_old.build_ids
         build_ids_added = build_ids_new - build_ids_old
         for added_id in build_ids_added:
             self.entries.append(model.ChangeRecord(
@@ -0,0 +1,137 @@
+"""
+Compression and json decoding for large payloads outside of the event loop.
+
+zlib releases the GIL, so compression runs in parallel on a thread pool. Json
+decoding keeps the GIL, in a thread it only stops the loop from stalling for the
+whole duration, a process pool actually moves the work to other cores.
+"""
+
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import multiprocessing
+import time
+import zlib
+
+
+
+DEFAULT_THRESHOLD = 64 * 1024
+
+def loads_lines(text):
+    """Decode json lines, skipping lines torn by an interrupted append"""
+    result = []
+    # Not splitlines, that would also split on unicode separators inside strings
+    for line in text.split("\n"):
+        if not line:
+            continue
+        try:
+            result.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return result
+
+class Codec:
+    def __init__(self, num_threads=0, num_processes=0, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.thread_pool = None
+        self.process_pool = None
+        if num_threads > 0:
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(
+                num_threads, thread_name_prefix="codec")
+        if num_processes > 0:
+            # Forking would copy the running event loop and the storage threads
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(
+                num_processes, mp_context=multiprocessing.get_context("spawn"))
+        self.num_inline = 0
+        self.num_offloaded = 0
+        self.bytes_offloaded = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            num_threads=config.get("CODEC_THREADS", 0),
+            num_processes=config.get("CODEC_PROCESSES", 0),
+            threshold=config.get("CODEC_THRESHOLD", DEFAULT_THRESHOLD)
+        )
+
+    def __repr__(self):
+        return (
+            f"Codec(inline={self.num_inline}, offloaded={self.num_offloaded}, "
+            f"bytes_offloaded={self.bytes_offloaded})"
+        )
+
+    async def run(self, executor, size, func, *args):
+        """Run func in executor if the payload is large enough, otherwise inline"""
+        if executor is None or size < self.threshold:
+            self.num_inline += 1
+            return func(*args)
+        self.num_offloaded += 1
+        self.bytes_offloaded += size
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    async def gzip_compress(self, data):
+        return await self.run(self.thread_pool, len(data), gzip.compress, data)
+
+    async def gzip_decompress(self, data):
+        return await self.run(self.thread_pool, len(data), gzip.decompress, data)
+
+    async def zlib_decompress(self, data, wbits=15):
+        return await self.run(self.thread_pool, len(data), zlib.decompress, data, wbits)
+
+    async def json_loads(self, text):
+        executor = self.process_pool or self.thread_pool
+        return await self.run(executor, len(text), json.loads, text)
+
+    async def json_loads_lines(self, text):
+        executor = self.process_pool or self.thread_pool
+        return await self.run(executor, len(text), loads_lines, text)
+
+    def close(self):
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+
+class LoopMonitor:
+    """Measures how long the event loop was blocked by oversleeping a periodic task"""
+    def __init__(self, interval=0.05, stall_threshold=0.1):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.task = None
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.num_stalls = 0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.task = asyncio.create_task(self.monitor())
+
+    async def monitor(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - before - self.interval
+            if lag > 0:
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+                if lag >= self.stall_threshold:
+                    self.num_stalls += 1
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self):
+        runtime = time.monotonic() - self.start_time
+        return (
+            f"Event loop blocked for {self.total_lag:.2f}s of {runtime:.2f}s, "
+            f"longest {self.max_lag * 1000:.0f}ms, "
+            f"{self.num_stalls} stalls over {self.stall_threshold * 1000:.0f}ms"
+        )
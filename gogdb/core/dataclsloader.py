@@ -16,15 +16,23 @@ def get_args(t):
     return getattr(t, "__args__", None)
 
 annotations_cache = {}
-def class_from_json(cls, data):
+def get_annotations(cls):
+    if cls in annotations_cache:
+        annotations = annotations_cache.get(cls)
+    else:
+        annotations = typing.get_type_hints(cls)
+        annotations_cache[cls] = annotations
+    return annotations
+
+def class_from_json_generic(cls, data):
+    """
+    Reference implementation that walks the type hints for every value.
+    Slow, but useful to verify the compiled loaders.
+    """
     if data is None:
         return None
     if dataclasses.is_dataclass(cls):
-        if cls in annotations_cache:
-            annotations = annotations_cache.get(cls)
-        else:
-            annotations = typing.get_type_hints(cls)
-            annotations_cache[cls] = annotations
+        annotations = get_annotations(cls)
         inst = cls()
         for field_name, field_value in data.items():
             try:
@@ -33,12 +41,9 @@ def class_from_json(cls, data):
                 if ignore_extra_fields:
                     continue
                 else:
-                    raise KeyError(
-                        "Invalid field {!r} in json. Valid fields for type {}: {!r}".format(
-                        field_name, cls, list(annotations.keys()))
-                    )
+                    raise_invalid_field(cls, field_name)
             try:
-                field_inst = class_from_json(field_type, field_value)
+                field_inst = class_from_json_generic(field_type, field_value)
             except TypeError:
                 raise TypeError(f"Failed to parse field {field_name}")
             setattr(inst, field_name, field_inst)
@@ -46,13 +51,147 @@ def class_from_json(cls, data):
     elif get_origin(cls) is list:
         list_element_type = get_args(cls)[0]
         return [
-            class_from_json(list_element_type, list_element) for
+            class_from_json_generic(list_element_type, list_element) for
             list_element in data]
     elif cls is datetime.datetime:
         return datetime.datetime.fromisoformat(data)
     else:
         if cls is not typing.Any:
             if not (type(data) is cls or data is None):
-                raise TypeError(f"{repr(data)} is of type {type(data)}, {cls} required")
+                raise_type_error(data, cls)
         return data
 
+def raise_invalid_field(cls, field_name):
+    raise KeyError(
+        "Invalid field {!r} in json. Valid fields for type {}: {!r}".format(
+        field_name, cls, list(get_annotations(cls).keys()))
+    )
+
+def raise_type_error(data, cls):
+    raise TypeError(f"{repr(data)} is of type {type(data)}, {cls} required")
+
+def check_extra_fields(cls, data):
+    """Called by compiled loaders if data contains fields they did not consume"""
+    if ignore_extra_fields:
+        return
+    annotations = get_annotations(cls)
+    for field_name in data:
+        if field_name not in annotations:
+            raise_invalid_field(cls, field_name)
+
+
+# Compiled loaders
+
+MISSING = object()
+loader_cache = {}
+
+def get_loader(cls):
+    """Return a function that turns json data into an instance of cls"""
+    loader = loader_cache.get(cls)
+    if loader is None:
+        # Placeholder for recursive types, replaced once compilation finishes
+        loader_cache[cls] = lambda data: loader_cache[cls](data)
+        try:
+            loader = compile_loader(cls)
+        except BaseException:
+            del loader_cache[cls]
+            raise
+        loader_cache[cls] = loader
+    return loader
+
+def class_from_json(cls, data):
+    return get_loader(cls)(data)
+
+class LoaderBuilder:
+    """Generates the source code of a loader function for a single type"""
+    def __init__(self):
+        self.namespace = {
+            "MISSING": MISSING,
+            "fromisoformat": datetime.datetime.fromisoformat,
+            "raise_type_error": raise_type_error,
+            "check_extra_fields": check_extra_fields
+        }
+        self.lines = []
+
+    def add_global(self, value):
+        name = f"g_{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def value_expression(self, cls, var):
+        """Expression converting var to cls, equivalent to class_from_json_generic"""
+        if dataclasses.is_dataclass(cls) or get_origin(cls) is list:
+            return f"{self.add_global(get_loader(cls))}({var})"
+        elif cls is datetime.datetime:
+            return f"(None if {var} is None else fromisoformat({var}))"
+        elif cls is typing.Any:
+            return var
+        else:
+            cls_name = self.add_global(cls)
+            return (
+                f"({var} if type({var}) is {cls_name} or {var} is None "
+                f"else raise_type_error({var}, {cls_name}))"
+            )
+
+    def build(self, name):
+        source = f"def {name}(data):\n" + "".join(f"    {line}\n" for line in self.lines)
+        exec(compile(source, f"<loader {name}>", "exec"), self.namespace)
+        return self.namespace[name]
+
+def can_skip_init(cls, annotations):
+    """Check if all fields can be filled without calling the generated __init__"""
+    fields = dataclasses.fields(cls)
+    if hasattr(cls, "__post_init__"):
+        return False
+    if set(annotations.keys()) != set(field.name for field in fields):
+        return False
+    for field in fields:
+        if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+            return False
+    return True
+
+def compile_loader(cls):
+    builder = LoaderBuilder()
+    lines = builder.lines
+    lines.append("if data is None:")
+    lines.append("    return None")
+    if dataclasses.is_dataclass(cls):
+        annotations = get_annotations(cls)
+        cls_name = builder.add_global(cls)
+        skip_init = can_skip_init(cls, annotations)
+        if skip_init:
+            lines.append(f"inst = {cls_name}.__new__({cls_name})")
+            defaults = {field.name: field for field in dataclasses.fields(cls)}
+        else:
+            lines.append(f"inst = {cls_name}()")
+        lines.append("matched = 0")
+        for field_name, field_type in annotations.items():
+            lines.append(f"value = data.get({field_name!r}, MISSING)")
+            lines.append("if value is MISSING:")
+            if skip_init:
+                field = defaults[field_name]
+                if field.default_factory is not dataclasses.MISSING:
+                    default_expr = f"{builder.add_global(field.default_factory)}()"
+                else:
+                    default_expr = builder.add_global(field.default)
+                lines.append(f"    inst.{field_name} = {default_expr}")
+            else:
+                lines.append("    pass")
+            lines.append("else:")
+            lines.append("    matched += 1")
+            lines.append("    try:")
+            lines.append(f"        inst.{field_name} = {builder.value_expression(field_type, 'value')}")
+            lines.append("    except TypeError:")
+            lines.append(f"        raise TypeError({f'Failed to parse field {field_name}'!r})")
+        lines.append("if matched != len(data):")
+        lines.append(f"    check_extra_fields({cls_name}, data)")
+        lines.append("return inst")
+        loader_name = f"load_{cls.__name__}"
+    elif get_origin(cls) is list:
+        element_expr = builder.value_expression(get_args(cls)[0], "element")
+        lines.append(f"return [{element_expr} for element in data]")
+        loader_name = "load_list"
+    else:
+        lines.append(f"return {builder.value_expression(cls, 'data')}")
+        loader_name = "load_value"
+    return builder.build(loader_name)
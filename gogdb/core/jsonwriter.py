@@ -0,0 +1,187 @@
+"""
+Serializes dataclass trees to json without converting them to dicts first.
+
+The pretty output is byte identical to
+json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=False, default=json_encoder)
+which is the format all storage files have been written in. Compact output uses
+the C encoder of the json module and only creates a shallow dict per dataclass.
+"""
+
+import dataclasses
+import datetime
+import json
+from json.encoder import encode_basestring
+
+
+
+INDENT = "  "
+
+field_names_cache = {}
+def get_field_names(cls):
+    field_names = field_names_cache.get(cls)
+    if field_names is None:
+        field_names = [field.name for field in dataclasses.fields(cls)]
+        field_names_cache[cls] = field_names
+    return field_names
+
+def json_encoder(x):
+    if dataclasses.is_dataclass(x):
+        # Shallow, the encoder calls this again for nested dataclasses
+        return {name: getattr(x, name) for name in get_field_names(type(x))}
+    elif isinstance(x, datetime.date) or isinstance(x, datetime.datetime):
+        assert x.tzinfo is not None
+        return x.isoformat()
+    else:
+        raise TypeError(type(x), repr(x))
+
+def json_dumps(obj, compact=False):
+    if compact:
+        return json.dumps(
+            obj, separators=(",", ":"), sort_keys=True, ensure_ascii=False, default=json_encoder)
+    chunks = []
+    write_value(obj, chunks, 0)
+    return "".join(chunks)
+
+
+def float_str(value):
+    # Same as the json module with allow_nan
+    if value != value:
+        return "NaN"
+    elif value == float("inf"):
+        return "Infinity"
+    elif value == float("-inf"):
+        return "-Infinity"
+    else:
+        return float.__repr__(value)
+
+def key_str(key):
+    if isinstance(key, str):
+        return key
+    elif isinstance(key, float):
+        return float_str(key)
+    elif key is True:
+        return "true"
+    elif key is False:
+        return "false"
+    elif key is None:
+        return "null"
+    elif isinstance(key, int):
+        return int.__repr__(key)
+    else:
+        raise TypeError(f"keys must be str, int, float, bool or None, not {type(key).__name__}")
+
+def write_str(value, chunks, level):
+    chunks.append(encode_basestring(value))
+
+def write_int(value, chunks, level):
+    chunks.append(int.__repr__(value))
+
+def write_float(value, chunks, level):
+    chunks.append(float_str(value))
+
+def write_bool(value, chunks, level):
+    chunks.append("true" if value else "false")
+
+def write_none(value, chunks, level):
+    chunks.append("null")
+
+def write_list(value, chunks, level):
+    if not value:
+        chunks.append("[]")
+        return
+    inner_indent = "\n" + INDENT * (level + 1)
+    separator = "," + inner_indent
+    chunks.append("[" + inner_indent)
+    first = True
+    for element in value:
+        if first:
+            first = False
+        else:
+            chunks.append(separator)
+        write_value(element, chunks, level + 1)
+    chunks.append("\n" + INDENT * level + "]")
+
+def write_dict(value, chunks, level):
+    if not value:
+        chunks.append("{}")
+        return
+    inner_indent = "\n" + INDENT * (level + 1)
+    separator = "," + inner_indent
+    chunks.append("{" + inner_indent)
+    first = True
+    for key, element in sorted(value.items()):
+        if first:
+            first = False
+        else:
+            chunks.append(separator)
+        chunks.append(encode_basestring(key_str(key)) + ": ")
+        write_value(element, chunks, level + 1)
+    chunks.append("\n" + INDENT * level + "}")
+
+def write_date(value, chunks, level):
+    assert value.tzinfo is not None
+    chunks.append(encode_basestring(value.isoformat()))
+
+class DataclassWriter:
+    """Writes the fields of a dataclass in sorted order with cached key prefixes"""
+    def __init__(self, cls):
+        field_names = sorted(get_field_names(cls))
+        self.field_names = field_names
+        self.keys = [encode_basestring(name) + ": " for name in field_names]
+        self.level_cache = {}
+
+    def get_prefixes(self, level):
+        prefixes = self.level_cache.get(level)
+        if prefixes is None:
+            inner_indent = "\n" + INDENT * (level + 1)
+            prefixes = [
+                ("{" if pos == 0 else ",") + inner_indent + key
+                for pos, key in enumerate(self.keys)
+            ]
+            closing = "\n" + INDENT * level + "}"
+            prefixes = (prefixes, closing)
+            self.level_cache[level] = prefixes
+        return prefixes
+
+    def __call__(self, value, chunks, level):
+        if not self.field_names:
+            chunks.append("{}")
+            return
+        prefixes, closing = self.get_prefixes(level)
+        for name, prefix in zip(self.field_names, prefixes):
+            chunks.append(prefix)
+            write_value(getattr(value, name), chunks, level + 1)
+        chunks.append(closing)
+
+writers = {
+    str: write_str,
+    int: write_int,
+    float: write_float,
+    bool: write_bool,
+    type(None): write_none,
+    list: write_list,
+    tuple: write_list,
+    dict: write_dict,
+    datetime.datetime: write_date,
+    datetime.date: write_date
+}
+
+def find_writer(cls):
+    """Slow path for types not yet in the writers table, keeps the json module's type precedence"""
+    if dataclasses.is_dataclass(cls):
+        return DataclassWriter(cls)
+    for base_cls in [str, bool, int, float, list, tuple, dict]:
+        if issubclass(cls, base_cls):
+            return writers[base_cls]
+    if issubclass(cls, datetime.date):
+        return write_date
+    return None
+
+def write_value(value, chunks, level):
+    writer = writers.get(type(value))
+    if writer is None:
+        writer = find_writer(type(value))
+        if writer is None:
+            raise TypeError(type(value), repr(value))
+        writers[type(value)] = writer
+    writer(value, chunks, level)
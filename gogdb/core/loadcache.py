@@ -0,0 +1,54 @@
+import collections
+import time
+
+
+
+# Seconds between reads of the generation file
+GENERATION_CHECK_INTERVAL = 1.0
+
+class LoadCache:
+    """
+    Bounded LRU cache of decoded storage items that is shared between requests.
+    Every entry carries a validator, like the file stat or the updater generation,
+    and is only returned if the current validator still matches.
+
+    Cached objects are handed out to every caller, so they must never be modified.
+    """
+    def __init__(self, max_entries, generation_path):
+        self.max_entries = max_entries
+        self.generation_path = generation_path
+        self.entries = collections.OrderedDict()
+        self.generation = None
+        self.generation_checked = None
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"LoadCache({len(self.entries)}/{self.max_entries}, hits={self.hits}, misses={self.misses})"
+
+    def get(self, key, validator):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != validator:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, validator, value):
+        self.entries[key] = (validator, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def current_generation(self):
+        """Generation number written by the updater, None if there is none yet"""
+        now = time.monotonic()
+        if self.generation_checked is None or now - self.generation_checked >= GENERATION_CHECK_INTERVAL:
+            try:
+                with open(self.generation_path, "r") as generation_file:
+                    self.generation = int(generation_file.read())
+            except (FileNotFoundError, ValueError):
+                self.generation = None
+            self.generation_checked = now
+        return self.generation
@@ -0,0 +1,105 @@
+"""
+In-memory index of known manifest ids, so the updater doesn't have to check the
+storage for every depot of every build.
+
+The index is a sorted array of 64 bit hashes of the ids, persisted as a flat
+file. Manifests are never deleted, so a missing id only costs a check of the
+actual storage and gets learned, while a hash collision would make the updater
+skip a manifest. At 8 bytes per id the chance of that stays far below one in a
+million for ten million manifests.
+"""
+
+import array
+import bisect
+import hashlib
+import heapq
+import os
+import sys
+
+from gogdb.core.packfile import FileLock
+
+
+
+def id_digest(mf_id):
+    return int.from_bytes(hashlib.blake2b(mf_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+def unique_sorted(digests):
+    result = array.array("Q")
+    previous = None
+    for digest in digests:
+        if digest != previous:
+            result.append(digest)
+            previous = digest
+    return result
+
+
+class ManifestIndex:
+    def __init__(self, path):
+        self.path = path
+        # Loaded on first use
+        self.digests = None
+        self.added = set()
+
+    def __repr__(self):
+        return f"ManifestIndex({repr(self.path)})"
+
+    def locked(self):
+        """Serializes writers of the index file across processes"""
+        os.makedirs(self.path.parent, exist_ok=True)
+        return FileLock(self.path.with_name(self.path.name + ".lock"))
+
+    def read_digests(self):
+        digests = array.array("Q")
+        try:
+            with open(self.path, "rb") as index_file:
+                digests.frombytes(index_file.read())
+        except FileNotFoundError:
+            pass
+        # Stored little endian
+        if sys.byteorder == "big":
+            digests.byteswap()
+        return digests
+
+    def write_digests(self, digests):
+        if sys.byteorder == "big":
+            digests = array.array("Q", digests)
+            digests.byteswap()
+        os.makedirs(self.path.parent, exist_ok=True)
+        temp_path = self.path.with_name(self.path.name + ".part")
+        with open(temp_path, "wb") as index_file:
+            digests.tofile(index_file)
+        os.replace(src=temp_path, dst=self.path)
+
+    def load(self):
+        if self.digests is None:
+            self.digests = self.read_digests()
+
+    def __contains__(self, mf_id):
+        digest = id_digest(mf_id)
+        if digest in self.added:
+            return True
+        self.load()
+        pos = bisect.bisect_left(self.digests, digest)
+        return pos < len(self.digests) and self.digests[pos] == digest
+
+    def add(self, mf_id):
+        self.added.add(id_digest(mf_id))
+
+    def save(self):
+        """Merge ids added since loading into the index file, which another process may have extended"""
+        if not self.added:
+            return
+        with self.locked():
+            digests = unique_sorted(heapq.merge(self.read_digests(), sorted(self.added)))
+            self.write_digests(digests)
+        self.digests = digests
+        self.added = set()
+
+    def rebuild(self, mf_ids):
+        """Replace the index with the given ids, returns the number of entries"""
+        digests = unique_sorted(sorted(id_digest(mf_id) for mf_id in mf_ids))
+        with self.locked():
+            self.write_digests(digests)
+        self.digests = digests
+        self.added = set()
+        return len(digests)
@@ -0,0 +1,360 @@
+"""
+Append-only pack storage for many small immutable blobs, like depot manifests.
+
+A pack is a directory containing numbered segment files and a single index file.
+Records are only ever appended to the newest segment. The index is an open
+addressing hash table with fixed size slots, so a lookup only needs a few
+positioned reads instead of loading the whole index into memory.
+
+Writers are serialized with an flock on the lock file. Readers don't take any
+locks, the index only gets replaced atomically when it grows.
+"""
+
+import fcntl
+import hashlib
+import os
+import pathlib
+import struct
+import threading
+
+
+
+INDEX_MAGIC = b"GOGDBIDX"
+INDEX_VERSION = 1
+# magic, version, current segment, committed size of the current segment,
+# number of buckets, number of entries
+INDEX_HEADER = struct.Struct("<8sIIQQQ")
+# key digest, segment number, record offset, record length
+INDEX_SLOT = struct.Struct("<16sIQI")
+EMPTY_DIGEST = bytes(16)
+INITIAL_BUCKETS = 1 << 16
+MAX_LOAD_FACTOR = 0.5
+PROBE_BATCH = 8
+
+RECORD_MAGIC = b"GPK1"
+# magic, key length, data length
+RECORD_HEADER = struct.Struct("<4sHI")
+
+MAX_SEGMENT_SIZE = 1 << 30
+
+
+class PackError(Exception):
+    pass
+
+def key_digest(key):
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+    if digest == EMPTY_DIGEST:
+        # Reserved for empty slots, astronomically unlikely
+        raise PackError(f"Key {key!r} hashes to the empty digest")
+    return digest
+
+
+class PackFile:
+    def __init__(self, path, max_segment_size=MAX_SEGMENT_SIZE):
+        self.path = pathlib.Path(path)
+        self.max_segment_size = max_segment_size
+        # flock only works between processes, threads need their own lock
+        self.thread_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"PackFile({repr(self.path)})"
+
+    def path_index(self):
+        return self.path / "index"
+
+    def path_lock(self):
+        return self.path / "lock"
+
+    def path_segment(self, segment_num):
+        return self.path / f"segment_{segment_num:05d}.pack"
+
+    def segment_numbers(self):
+        numbers = []
+        try:
+            filenames = os.listdir(self.path)
+        except FileNotFoundError:
+            return numbers
+        for filename in filenames:
+            if filename.startswith("segment_") and filename.endswith(".pack"):
+                numbers.append(int(filename[len("segment_"):-len(".pack")]))
+        numbers.sort()
+        return numbers
+
+    # Reading
+
+    @staticmethod
+    def read_header(index_file):
+        header_data = os.pread(index_file.fileno(), INDEX_HEADER.size, 0)
+        if len(header_data) != INDEX_HEADER.size:
+            raise PackError("Truncated index header")
+        magic, version, *header = INDEX_HEADER.unpack(header_data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise PackError("Invalid index header")
+        # current segment, segment size, number of buckets, number of entries
+        return header
+
+    @staticmethod
+    def probe(index_file, num_buckets, digest):
+        """
+        Find the slot for digest. Returns the slot number and its content, which is either
+        the matching entry or an empty slot.
+        """
+        fd = index_file.fileno()
+        bucket = int.from_bytes(digest[:8], "little") & (num_buckets - 1)
+        probed = 0
+        while probed < num_buckets:
+            batch_size = min(PROBE_BATCH, num_buckets - bucket, num_buckets - probed)
+            batch_data = os.pread(
+                fd, INDEX_SLOT.size * batch_size, INDEX_HEADER.size + INDEX_SLOT.size * bucket)
+            for batch_pos in range(batch_size):
+                slot = INDEX_SLOT.unpack_from(batch_data, batch_pos * INDEX_SLOT.size)
+                if slot[0] == digest or slot[0] == EMPTY_DIGEST:
+                    return bucket + batch_pos, slot
+            probed += batch_size
+            bucket = (bucket + batch_size) & (num_buckets - 1)
+        raise PackError("Index is full")
+
+    def lookup(self, key):
+        """Returns a tuple of (segment, offset, length) or None"""
+        digest = key_digest(key)
+        try:
+            index_file = open(self.path_index(), "rb")
+        except FileNotFoundError:
+            return None
+        with index_file:
+            cur_segment, segment_size, num_buckets, count = self.read_header(index_file)
+            slot_num, slot = self.probe(index_file, num_buckets, digest)
+        if slot[0] == EMPTY_DIGEST:
+            return None
+        return slot[1:]
+
+    def read_record(self, segment_num, offset, length, key=None):
+        with open(self.path_segment(segment_num), "rb") as segment_file:
+            record = os.pread(segment_file.fileno(), length, offset)
+        if len(record) != length:
+            raise PackError(f"Truncated record in segment {segment_num} at {offset}")
+        magic, key_len, data_len = RECORD_HEADER.unpack_from(record)
+        if magic != RECORD_MAGIC or RECORD_HEADER.size + key_len + data_len != length:
+            raise PackError(f"Invalid record in segment {segment_num} at {offset}")
+        record_key = record[RECORD_HEADER.size:RECORD_HEADER.size + key_len].decode("utf-8")
+        if key is not None and record_key != key:
+            raise PackError(f"Record key {record_key!r} does not match {key!r}")
+        return record[RECORD_HEADER.size + key_len:]
+
+    def get(self, key):
+        location = self.lookup(key)
+        if location is None:
+            return None
+        return self.read_record(*location, key=key)
+
+    def has(self, key):
+        return self.lookup(key) is not None
+
+    def keys(self):
+        """Iterate the keys of all records in segment order, including overwritten ones"""
+        for segment_num, offset, length, key in self.scan():
+            yield key
+
+    def scan(self):
+        """Iterate all records as (segment, offset, length, key), ignoring a torn tail"""
+        for segment_num in self.segment_numbers():
+            with open(self.path_segment(segment_num), "rb") as segment_file:
+                offset = 0
+                while True:
+                    header_data = segment_file.read(RECORD_HEADER.size)
+                    if len(header_data) != RECORD_HEADER.size:
+                        break
+                    magic, key_len, data_len = RECORD_HEADER.unpack(header_data)
+                    if magic != RECORD_MAGIC:
+                        break
+                    key_data = segment_file.read(key_len)
+                    if len(key_data) != key_len:
+                        break
+                    segment_file.seek(data_len, os.SEEK_CUR)
+                    length = RECORD_HEADER.size + key_len + data_len
+                    if offset + length > os.fstat(segment_file.fileno()).st_size:
+                        break
+                    yield segment_num, offset, length, key_data.decode("utf-8")
+                    offset += length
+
+    # Writing
+
+    def put(self, key, data):
+        self.put_many([(key, data)])
+
+    def put_many(self, items):
+        """Append (key, data) pairs. Returns the number of records written."""
+        num_written = 0
+        with self.thread_lock, self.locked():
+            index_file = self.open_index()
+            cur_segment, segment_size, num_buckets, count = self.read_header(index_file)
+            segment_file = self.open_segment(cur_segment, segment_size)
+            try:
+                for key, data in items:
+                    key_bytes = key.encode("utf-8")
+                    record = RECORD_HEADER.pack(RECORD_MAGIC, len(key_bytes), len(data)) \
+                        + key_bytes + data
+                    if segment_size > 0 and segment_size + len(record) > self.max_segment_size:
+                        # Full segments are never written again, sync only has to
+                        # handle the current one
+                        os.fsync(segment_file.fileno())
+                        segment_file.close()
+                        cur_segment += 1
+                        segment_size = 0
+                        segment_file = self.open_segment(cur_segment, segment_size)
+                    offset = segment_size
+                    segment_file.write(record)
+                    # The record has to be committed before the index points to it
+                    segment_file.flush()
+                    segment_size += len(record)
+                    self.write_header(index_file, cur_segment, segment_size, num_buckets, count)
+
+                    if count + 1 > num_buckets * MAX_LOAD_FACTOR:
+                        index_file.close()
+                        self.write_index(
+                            self.read_entries(), num_buckets * 2, cur_segment, segment_size)
+                        index_file = self.open_index()
+                        cur_segment, segment_size, num_buckets, count = \
+                            self.read_header(index_file)
+                    is_new = self.insert(
+                        index_file, num_buckets, key_digest(key),
+                        cur_segment, offset, len(record))
+                    if is_new:
+                        count += 1
+                        self.write_header(
+                            index_file, cur_segment, segment_size, num_buckets, count)
+                    num_written += 1
+            finally:
+                segment_file.close()
+                index_file.close()
+        return num_written
+
+    def sync(self):
+        """Make all records written so far durable, for example before deleting their source"""
+        with self.thread_lock, self.locked():
+            try:
+                index_file = open(self.path_index(), "rb")
+            except FileNotFoundError:
+                return
+            with index_file:
+                cur_segment, segment_size, num_buckets, count = self.read_header(index_file)
+                try:
+                    with open(self.path_segment(cur_segment), "rb") as segment_file:
+                        os.fsync(segment_file.fileno())
+                except FileNotFoundError:
+                    pass
+                os.fsync(index_file.fileno())
+            # New segments and a replaced index are only durable with their directory entry
+            dir_fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def locked(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        return FileLock(self.path_lock())
+
+    def open_index(self):
+        """Open the index for writing, creating it if needed. Requires the write lock."""
+        try:
+            return open(self.path_index(), "r+b")
+        except FileNotFoundError:
+            self.write_index([], INITIAL_BUCKETS, 0, 0)
+            return open(self.path_index(), "r+b")
+
+    def open_segment(self, segment_num, segment_size):
+        """
+        Open a segment for appending. Anything after the committed size is left over from
+        an interrupted write and gets cut off.
+        """
+        segment_path = self.path_segment(segment_num)
+        try:
+            segment_file = open(segment_path, "r+b")
+        except FileNotFoundError:
+            segment_file = open(segment_path, "w+b")
+        segment_file.truncate(segment_size)
+        segment_file.seek(segment_size)
+        return segment_file
+
+    @staticmethod
+    def write_header(index_file, cur_segment, segment_size, num_buckets, count):
+        os.pwrite(
+            index_file.fileno(),
+            INDEX_HEADER.pack(
+                INDEX_MAGIC, INDEX_VERSION, cur_segment, segment_size, num_buckets, count),
+            0
+        )
+
+    def insert(self, index_file, num_buckets, digest, segment_num, offset, length):
+        slot_num, slot = self.probe(index_file, num_buckets, digest)
+        os.pwrite(
+            index_file.fileno(),
+            INDEX_SLOT.pack(digest, segment_num, offset, length),
+            INDEX_HEADER.size + INDEX_SLOT.size * slot_num
+        )
+        return slot[0] == EMPTY_DIGEST
+
+    def read_entries(self):
+        """Read all occupied index slots. Requires the write lock."""
+        with open(self.path_index(), "rb") as index_file:
+            cur_segment, segment_size, num_buckets, count = self.read_header(index_file)
+            index_file.seek(INDEX_HEADER.size)
+            entries = []
+            remaining = num_buckets
+            while remaining > 0:
+                chunk_size = min(remaining, INITIAL_BUCKETS)
+                chunk = index_file.read(INDEX_SLOT.size * chunk_size)
+                for slot in INDEX_SLOT.iter_unpack(chunk):
+                    if slot[0] != EMPTY_DIGEST:
+                        entries.append(slot)
+                remaining -= chunk_size
+        return entries
+
+    def write_index(self, entries, num_buckets, cur_segment, segment_size):
+        """Atomically replace the index with a new one. Requires the write lock."""
+        while len(entries) > num_buckets * MAX_LOAD_FACTOR:
+            num_buckets *= 2
+        index_path = self.path_index()
+        temp_path = index_path.with_name(index_path.name + ".part")
+        with open(temp_path, "w+b") as index_file:
+            index_file.truncate(INDEX_HEADER.size + INDEX_SLOT.size * num_buckets)
+            for digest, segment_num, offset, length in entries:
+                self.insert(index_file, num_buckets, digest, segment_num, offset, length)
+            self.write_header(index_file, cur_segment, segment_size, num_buckets, len(entries))
+            # Otherwise the replaced index could end up empty after a crash
+            os.fsync(index_file.fileno())
+        os.replace(src=temp_path, dst=index_path)
+
+    def rebuild_index(self):
+        """Recreate the index from the segment files. Later records win."""
+        with self.thread_lock, self.locked():
+            entries = {}
+            cur_segment = 0
+            segment_size = 0
+            for segment_num, offset, length, key in self.scan():
+                digest = key_digest(key)
+                entries[digest] = (digest, segment_num, offset, length)
+                if segment_num != cur_segment:
+                    cur_segment = segment_num
+                    segment_size = 0
+                segment_size = offset + length
+            self.write_index(
+                list(entries.values()), INITIAL_BUCKETS, cur_segment, segment_size)
+        return len(entries)
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fobj = None
+
+    def __enter__(self):
+        self.fobj = open(self.path, "a+b")
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_UN)
+        self.fobj.close()
+        self.fobj = None
@@ -1,30 +1,25 @@
-import dataclasses
-import json
-import datetime
-import gzip
 import pathlib
 import itertools
 import string
 import os
 import os.path
+import asyncio
+import contextlib
+import json
 
 import aiofiles
+import aiosqlite
 
 import gogdb.core.model as model
 from gogdb.core.dataclsloader import class_from_json
+from gogdb.core.packfile import PackFile
+from gogdb.core.manifestindex import ManifestIndex
+from gogdb.core.jsonwriter import json_encoder, json_dumps
+from gogdb.core.codec import Codec
 
 
-def json_encoder(x):
-    if dataclasses.is_dataclass(x):
-        return dataclasses.asdict(x)
-    elif isinstance(x, datetime.date) or isinstance(x, datetime.datetime):
-        assert x.tzinfo is not None
-        return x.isoformat()
-    else:
-        raise TypeError(type(x), repr(x))
-
 def json_dump(obj, f):
-    json.dump(obj, f, indent=2, sort_keys=True, ensure_ascii=False, default=json_encoder)
+    f.write(json_dumps(obj))
 
 LEGAL_PARAMETER_CHARS = set(string.ascii_letters + string.digits + "-_.")
 def params_legal(args, kwargs):
@@ -38,41 +33,64 @@ def params_legal(args, kwargs):
 
 
 class StorageItem:
-    def __init__(self, path_function, make_function=None, compressed=False):
+    def __init__(self, path_function, make_function=None, compressed=False, cache=None,
+                 compact=False, codec=None):
         self.path_function = path_function
         self.make_function = make_function
         self.compressed = compressed
+        self.cache = cache
+        self.compact = compact
+        self.codec = codec or Codec()
 
     async def load(self, *args, **kwargs):
         # Prevent directory traversal and other funny stuff
         if not params_legal(args, kwargs):
             return None
         path = self.path_function(*args, **kwargs)
+        if self.cache is not None:
+            # Stat before reading, so a concurrent replace can only make the entry stale
+            try:
+                path_stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            validator = (path_stat.st_ino, path_stat.st_mtime_ns, path_stat.st_size)
+            cached = self.cache.get(path, validator)
+            if cached is not None:
+                return cached
         try:
             if self.compressed:
                 async with aiofiles.open(path, "rb") as fobj:
                     content_compressed = await fobj.read()
-                file_content = gzip.decompress(content_compressed).decode("utf-8")
+                content_binary = await self.codec.gzip_decompress(content_compressed)
+                file_content = content_binary.decode("utf-8")
             else:
                 async with aiofiles.open(path, "r") as fobj:
                     file_content = await fobj.read()
         except FileNotFoundError:
             return None
-        json_data = json.loads(file_content)
+        json_data = await self.decode(file_content)
         if self.make_function:
-            return self.make_function(json_data)
+            result = self.make_function(json_data)
         else:
-            return json_data
+            result = json_data
+        if self.cache is not None:
+            self.cache.put(path, validator, result)
+        return result
+
+    async def decode(self, file_content):
+        return await self.codec.json_loads(file_content)
+
+    def encode(self, instance):
+        return json_dumps(instance, compact=self.compact)
 
     async def save(self, instance, *args, **kwargs):
         if not params_legal(args, kwargs):
             return None
         path = self.path_function(*args, **kwargs)
         temp_path = str(path) + ".part"
-        json_data = json.dumps(
-            instance, indent=2, sort_keys=True, ensure_ascii=False, default=json_encoder)
+        json_data = self.encode(instance)
         if self.compressed:
-            content_compressed = gzip.compress(json_data.encode("utf-8"))
+            content_compressed = await self.codec.gzip_compress(json_data.encode("utf-8"))
         try:
             if self.compressed:
                 async with aiofiles.open(temp_path, "wb") as fobj:
@@ -97,33 +115,558 @@ class StorageItem:
         path = self.path_function(*args, **kwargs)
         return os.path.exists(path)
 
+    async def remove(self, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        try:
+            os.remove(self.path_function(*args, **kwargs))
+        except FileNotFoundError:
+            pass
+
+    async def append(self, entries, *args, **kwargs):
+        """Add entries to a list item, which requires rewriting the whole file"""
+        if not entries or not params_legal(args, kwargs):
+            return None
+        # Copy, the loaded list might be shared through the cache
+        content = list(await self.load(*args, **kwargs) or [])
+        content.extend(entries)
+        await self.save(content, *args, **kwargs)
+
+
+class JsonLinesStorageItem(StorageItem):
+    """
+    List item stored as one json document per line. Appending only writes the new entries,
+    save rewrites the file and drops lines damaged by an interrupted append.
+    """
+    async def decode(self, file_content):
+        return await self.codec.json_loads_lines(file_content)
+
+    def encode(self, instance):
+        return "".join(json_dumps(entry, compact=True) + "\n" for entry in instance)
+
+    async def append(self, entries, *args, **kwargs):
+        if not entries or not params_legal(args, kwargs):
+            return None
+        path = self.path_function(*args, **kwargs)
+        lines = self.encode(entries)
+        try:
+            with open(path, "rb") as fobj:
+                fobj.seek(0, os.SEEK_END)
+                if fobj.tell() > 0:
+                    fobj.seek(-1, os.SEEK_END)
+                    # Start a new line if the last append was interrupted
+                    if fobj.read(1) != b"\n":
+                        lines = "\n" + lines
+        except FileNotFoundError:
+            os.makedirs(path.parent, exist_ok=True)
+        async with aiofiles.open(path, "a") as fobj:
+            await fobj.write(lines)
+
+
+TAIL_CHUNK_SIZE = 4096
+
+def read_tail_lines(path, count, match):
+    """
+    Read json lines backwards from the end of the file until count of them match.
+    Returns the matches as (offset, data) in file order and whether the newest match
+    is the last valid line of the file, or None if the file doesn't exist.
+    """
+    try:
+        fobj = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    matches = []
+    is_last = True
+    with fobj:
+        pos = fobj.seek(0, os.SEEK_END)
+        # Holds the part of the file from pos that hasn't been split into lines yet
+        buffer = b""
+        while len(matches) < count:
+            newline = buffer.rfind(b"\n")
+            if newline == -1 and pos > 0:
+                read_size = min(TAIL_CHUNK_SIZE, pos)
+                pos -= read_size
+                buffer = os.pread(fobj.fileno(), read_size, pos) + buffer
+                continue
+            line = buffer[newline + 1:]
+            line_offset = pos + newline + 1
+            buffer = buffer[:max(newline, 0)]
+            if line:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # Torn by an interrupted append
+                    data = None
+                if data is not None:
+                    if match(data):
+                        matches.append((line_offset, data))
+                    elif not matches:
+                        is_last = False
+            if newline == -1:
+                break
+    matches.reverse()
+    return matches, is_last
+
+
+class PriceLogStorageItem(JsonLinesStorageItem):
+    """
+    Price log stored as one json line per record, oldest first. Loading returns the same
+    nested {country: {currency: [records]}} structure as prices.json. The updater only
+    looks at the newest records, those are read backwards from the end of the file.
+    """
+    async def decode(self, file_content):
+        lines = await self.codec.json_loads_lines(file_content)
+        return self.lines_to_log(lines)
+
+    @staticmethod
+    def lines_to_log(lines):
+        price_log = {}
+        for line in lines:
+            country = line.pop("country")
+            price_log.setdefault(country, {}).setdefault(line["currency"], []).append(line)
+        return price_log
+
+    def encode(self, instance):
+        lines = []
+        for country, country_log in instance.items():
+            for currency_log in country_log.values():
+                for record in currency_log:
+                    if not isinstance(record, dict):
+                        record = json_encoder(record)
+                    lines.append(json_dumps({"country": country, **record}, compact=True) + "\n")
+        return "".join(lines)
+
+    async def read_tail(self, country, currency, count, *args, **kwargs):
+        path = self.path_function(*args, **kwargs)
+        def match(data):
+            return data.get("country") == country and data.get("currency") == currency
+        return await asyncio.to_thread(read_tail_lines, path, count, match)
+
+    async def load_tail(self, country, currency, count, *args, **kwargs):
+        """The newest count records of one currency, None if there is no price log"""
+        if not params_legal(args, kwargs):
+            return None
+        tail = await self.read_tail(country, currency, count, *args, **kwargs)
+        if tail is None:
+            return None
+        matches, is_last = tail
+        price_log = self.lines_to_log([data for offset, data in matches])
+        if self.make_function:
+            price_log = self.make_function(price_log)
+        return price_log.get(country, {}).get(currency, [])
+
+    async def append_record(self, country, record, *args, **kwargs):
+        await self.append({country: {record.currency: [record]}}, *args, **kwargs)
+
+    async def pop_record(self, country, currency, *args, **kwargs):
+        """Remove the newest record of one currency"""
+        if not params_legal(args, kwargs):
+            return None
+        tail = await self.read_tail(country, currency, 1, *args, **kwargs)
+        if tail is None or not tail[0]:
+            return None
+        matches, is_last = tail
+        if is_last:
+            # Also cuts off anything left over from an interrupted append
+            path = self.path_function(*args, **kwargs)
+            await asyncio.to_thread(os.truncate, path, matches[-1][0])
+        else:
+            await PriceLogAdapter(self).pop_record(country, currency, *args, **kwargs)
+
+
+class PriceLogAdapter:
+    """
+    Price log operations for items that store the whole log as one document,
+    every operation loads and rewrites the complete log.
+    """
+    def __init__(self, item):
+        self.item = item
+
+    def __getattr__(self, name):
+        return getattr(self.item, name)
+
+    async def load_tail(self, country, currency, count, *args, **kwargs):
+        price_log = await self.item.load(*args, **kwargs)
+        if price_log is None:
+            return None
+        return price_log.get(country, {}).get(currency, [])[-count:]
+
+    async def modify_currency_log(self, country, currency, modify, *args, **kwargs):
+        price_log = await self.item.load(*args, **kwargs)
+        if price_log is None:
+            price_log = {}
+        # Copy, the loaded log might be shared through the cache
+        price_log = {log_country: dict(country_log) for log_country, country_log in price_log.items()}
+        country_log = price_log.setdefault(country, {})
+        country_log[currency] = modify(list(country_log.get(currency, [])))
+        await self.item.save(price_log, *args, **kwargs)
+
+    async def append_record(self, country, record, *args, **kwargs):
+        await self.modify_currency_log(
+            country, record.currency, lambda currency_log: currency_log + [record],
+            *args, **kwargs)
+
+    async def pop_record(self, country, currency, *args, **kwargs):
+        await self.modify_currency_log(
+            country, currency, lambda currency_log: currency_log[:-1], *args, **kwargs)
+
+
+class PackStorageItem:
+    """Compressed item stored as a record in a pack instead of its own file"""
+    def __init__(self, pack_path, key_function, make_function=None, compact=False, codec=None):
+        self.pack = PackFile(pack_path)
+        self.key_function = key_function
+        self.make_function = make_function
+        self.compact = compact
+        self.codec = codec or Codec()
+
+    async def load(self, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        key = self.key_function(*args, **kwargs)
+        content_compressed = await asyncio.to_thread(self.pack.get, key)
+        if content_compressed is None:
+            return None
+        content = await self.codec.gzip_decompress(content_compressed)
+        json_data = await self.codec.json_loads(content.decode("utf-8"))
+        if self.make_function:
+            return self.make_function(json_data)
+        else:
+            return json_data
+
+    async def save(self, instance, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        key = self.key_function(*args, **kwargs)
+        json_data = json_dumps(instance, compact=self.compact)
+        content_compressed = await self.codec.gzip_compress(json_data.encode("utf-8"))
+        await asyncio.to_thread(self.pack.put, key, content_compressed)
+
+    async def has(self, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        key = self.key_function(*args, **kwargs)
+        return await asyncio.to_thread(self.pack.has, key)
+
+
+class IndexedManifestItem:
+    """Manifest item that answers has from the in-memory index of known manifests"""
+    def __init__(self, item, index):
+        self.item = item
+        self.index = index
+
+    async def load(self, *args, **kwargs):
+        return await self.item.load(*args, **kwargs)
+
+    async def save(self, instance, manifest_id):
+        await self.item.save(instance, manifest_id)
+        self.index.add(manifest_id)
+
+    async def has(self, manifest_id):
+        if not params_legal([manifest_id], {}):
+            return None
+        if self.index.digests is None:
+            await asyncio.to_thread(self.index.load)
+        if manifest_id in self.index:
+            return True
+        # Not indexed yet, for example saved by an interrupted run
+        if await self.item.has(manifest_id):
+            self.index.add(manifest_id)
+            return True
+        return False
+
+
+# Seconds to wait for the write lock, which another updater shard may hold for a batch
+SQLITE_BUSY_TIMEOUT = 60.0
+
+class SqliteBackend:
+    """Single database file with one key-value table per storage item"""
+    def __init__(self, storage_path, db_path):
+        self.storage_path = storage_path
+        self.db_path = db_path
+        self.tables = set()
+        self.conn = None
+        self.connect_lock = asyncio.Lock()
+
+    def make_key(self, path):
+        """Items are keyed by their path relative to the storage directory"""
+        return str(path.relative_to(self.storage_path))
+
+    async def get_connection(self):
+        async with self.connect_lock:
+            if self.conn is None:
+                os.makedirs(self.db_path.parent, exist_ok=True)
+                conn = await aiosqlite.connect(
+                    self.db_path, isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT)
+                # WAL allows the web app to read while the updater writes and
+                # skips most of the syncing on commit
+                await conn.execute("PRAGMA journal_mode=WAL;")
+                await conn.execute("PRAGMA synchronous=NORMAL;")
+                for table in sorted(self.tables):
+                    await conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {table} "
+                        "(key TEXT PRIMARY KEY, content TEXT NOT NULL) WITHOUT ROWID;"
+                    )
+                self.conn = conn
+        return self.conn
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Commit all writes made on the connection inside the block at once. Writes are kept
+        if the block raises, like they would be without the transaction.
+        """
+        conn = await self.get_connection()
+        # Take the write lock right away. A deferred transaction that reads first fails
+        # without waiting if another process commits before its first write.
+        await conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+        finally:
+            await conn.execute("COMMIT;")
+
+    async def close(self):
+        async with self.connect_lock:
+            if self.conn is not None:
+                await self.conn.close()
+                self.conn = None
+
+
+class SqliteStorageItem:
+    """Item stored as a row in a table of the sqlite backend instead of its own file"""
+    def __init__(self, backend, table, path_function, make_function=None, cache=None,
+                 compact=False, codec=None):
+        self.backend = backend
+        self.table = table
+        self.path_function = path_function
+        self.make_function = make_function
+        self.cache = cache
+        self.compact = compact
+        self.codec = codec or Codec()
+        backend.tables.add(table)
+
+    async def load(self, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        key = self.backend.make_key(self.path_function(*args, **kwargs))
+        # Rows have no modification time, so entries are only valid for one updater run
+        generation = None
+        if self.cache is not None:
+            generation = self.cache.current_generation()
+            if generation is not None:
+                cached = self.cache.get((self.table, key), generation)
+                if cached is not None:
+                    return cached
+        conn = await self.backend.get_connection()
+        async with conn.execute(f"SELECT content FROM {self.table} WHERE key = ?;", (key,)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        json_data = await self.codec.json_loads(row[0])
+        if self.make_function:
+            result = self.make_function(json_data)
+        else:
+            result = json_data
+        if generation is not None:
+            self.cache.put((self.table, key), generation, result)
+        return result
+
+    async def save(self, instance, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        key = self.backend.make_key(self.path_function(*args, **kwargs))
+        json_data = json_dumps(instance, compact=self.compact)
+        conn = await self.backend.get_connection()
+        await conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, content) VALUES (?, ?);", (key, json_data))
+
+    async def has(self, *args, **kwargs):
+        if not params_legal(args, kwargs):
+            return None
+        key = self.backend.make_key(self.path_function(*args, **kwargs))
+        conn = await self.backend.get_connection()
+        async with conn.execute(f"SELECT 1 FROM {self.table} WHERE key = ?;", (key,)) as cur:
+            row = await cur.fetchone()
+        return row is not None
+
+    async def append(self, entries, *args, **kwargs):
+        """Add entries to a list item by rewriting the row"""
+        if not entries or not params_legal(args, kwargs):
+            return None
+        content = list(await self.load(*args, **kwargs) or [])
+        content.extend(entries)
+        await self.save(content, *args, **kwargs)
+
+
+STORAGE_BACKENDS = ["files", "sqlite"]
 
 class Storage:
-    def __init__(self, storage_path):
+    def __init__(self, storage_path, backend="files", manifest_packs=False, load_cache=None,
+                 compact_json=False, codec=None, changelog_jsonl=False, prices_jsonl=False,
+                 manifest_index=False):
         self.storage_path = pathlib.Path(storage_path)
+        # Default codec runs everything inline
+        self.codec = codec or Codec()
+        self.manifest_packs = manifest_packs
+        self.load_cache = load_cache
+        # Only used for bulk data, small files stay readable
+        self.compact_json = compact_json
+        self.changelog_jsonl = changelog_jsonl
+        self.prices_jsonl = prices_jsonl
+        if backend not in STORAGE_BACKENDS:
+            raise ValueError(f"Invalid storage backend {backend!r}, valid: {STORAGE_BACKENDS}")
+        # To open the same storage again with its own connection
+        self.options = dict(
+            backend=backend, manifest_packs=manifest_packs, load_cache=load_cache,
+            compact_json=compact_json, codec=self.codec, changelog_jsonl=changelog_jsonl,
+            prices_jsonl=prices_jsonl
+        )
+        if backend == "sqlite":
+            self.backend = SqliteBackend(self.storage_path, self.path_sqlite())
+        else:
+            self.backend = None
 
         self.ids = StorageItem(self.path_ids)
         self.token = StorageItem(self.path_token)
-        self.product = StorageItem(self.path_product, self.make_product)
-        self.repository = StorageItem(self.path_repository)
-        self.prices = StorageItem(self.path_prices, self.make_prices)
-        self.prices_old = StorageItem(self.path_prices_old, self.make_prices)
-        self.changelog = StorageItem(self.path_changelog, self.make_changelog)
-        self.manifest_v1 = StorageItem(self.path_manifest_v1, compressed=True)
-        self.manifest_v2 = StorageItem(self.path_manifest_v2, compressed=True)
-        self.startpage = StorageItem(self.path_startpage, self.make_startpage)
-        self.versions = StorageItem(self.path_versions, self.make_versions)
+        self.generation = StorageItem(self.path_generation)
+        self.schedule = StorageItem(self.path_schedule, compact=True)
+        self.checkpoint = StorageItem(self.path_checkpoint, compact=True)
+        self.journal = StorageItem(self.path_journal, compact=True)
+        self.processed = StorageItem(self.path_processed)
+        self.processor_profile = StorageItem(self.path_processor_profile)
+        # Per product items, these can live in the backend
+        self.product = self.backend_item("product", self.path_product, self.make_product)
+        self.repository = self.backend_item("repository", self.path_repository)
+        if prices_jsonl and self.backend is None:
+            self.prices = PriceLogStorageItem(
+                self.path_prices_jsonl, self.make_prices, cache=load_cache, codec=self.codec)
+        else:
+            self.prices = PriceLogAdapter(
+                self.backend_item("prices", self.path_prices, self.make_prices))
+        self.prices_old = self.backend_item("prices_old", self.path_prices_old, self.make_prices)
+        if changelog_jsonl and self.backend is None:
+            self.changelog = JsonLinesStorageItem(
+                self.path_changelog_jsonl, self.make_changelog,
+                cache=load_cache, codec=self.codec)
+        else:
+            self.changelog = self.backend_item(
+                "changelog", self.path_changelog, self.make_changelog)
+        if manifest_packs:
+            self.manifest_v1 = PackStorageItem(
+                self.path_pack_manifest_v1(), self.key_manifest,
+                compact=compact_json, codec=self.codec)
+            self.manifest_v2 = PackStorageItem(
+                self.path_pack_manifest_v2(), self.key_manifest,
+                compact=compact_json, codec=self.codec)
+        else:
+            self.manifest_v1 = StorageItem(
+                self.path_manifest_v1, compressed=True, compact=compact_json, codec=self.codec)
+            self.manifest_v2 = StorageItem(
+                self.path_manifest_v2, compressed=True, compact=compact_json, codec=self.codec)
+        self.manifest_indexes = []
+        if manifest_index:
+            self.manifest_indexes = [
+                ManifestIndex(self.path_manifest_index("v1")),
+                ManifestIndex(self.path_manifest_index("v2"))
+            ]
+            self.manifest_v1 = IndexedManifestItem(self.manifest_v1, self.manifest_indexes[0])
+            self.manifest_v2 = IndexedManifestItem(self.manifest_v2, self.manifest_indexes[1])
+        self.startpage = StorageItem(self.path_startpage, self.make_startpage, cache=load_cache)
+        self.versions = StorageItem(self.path_versions, self.make_versions, cache=load_cache)
         self.user = StorageItem(self.path_user)
+        self.http_cache = StorageItem(
+            self.path_http_cache, compressed=True, compact=True, codec=self.codec)
+
+    @classmethod
+    def from_config(cls, config, load_cache=None, codec=None):
+        return cls(
+            config["STORAGE_PATH"],
+            backend=config.get("STORAGE_BACKEND", "files"),
+            manifest_packs=config.get("STORAGE_MANIFEST_PACKS", False),
+            load_cache=load_cache,
+            compact_json=config.get("STORAGE_COMPACT_JSON", False),
+            codec=codec,
+            changelog_jsonl=config.get("STORAGE_CHANGELOG_JSONL", False),
+            prices_jsonl=config.get("STORAGE_PRICES_JSONL", False),
+            manifest_index=config.get("STORAGE_MANIFEST_INDEX", False)
+        )
 
     def __repr__(self):
         return f"Storage({repr(self.storage_path)})"
 
+    def backend_item(self, table, path_function, make_function=None):
+        if self.backend is None:
+            return StorageItem(
+                path_function, make_function, cache=self.load_cache,
+                compact=self.compact_json, codec=self.codec)
+        else:
+            return SqliteStorageItem(
+                self.backend, table, path_function, make_function,
+                cache=self.load_cache, compact=self.compact_json, codec=self.codec)
+
+    async def close(self):
+        for index in self.manifest_indexes:
+            await asyncio.to_thread(index.save)
+        if self.backend is not None:
+            await self.backend.close()
+
+    @contextlib.asynccontextmanager
+    async def write_batch(self):
+        """Group many small writes, only has an effect with the sqlite backend"""
+        if self.backend is None:
+            yield
+        else:
+            async with self.backend.transaction():
+                yield
+
+    @contextlib.asynccontextmanager
+    async def separate_connection(self):
+        """
+        The same storage with its own sqlite connection, so its write batches don't pick
+        up writes of other tasks. Manifests must not be saved through it, their index
+        belongs to the original storage. With the file backend this is the storage itself.
+        """
+        if self.backend is None:
+            yield self
+            return
+        storage = Storage(self.storage_path, **self.options)
+        try:
+            yield storage
+        finally:
+            await storage.close()
+
+    async def bump_generation(self):
+        """Invalidate the load caches of all running web app processes"""
+        generation = await self.generation.load()
+        if generation is None:
+            generation = 0
+        await self.generation.save(generation + 1)
+        return generation + 1
+
     def path_ids(self):
         return self.storage_path / "ids.json"
 
     def path_token(self):
         return self.storage_path / "secret/token.json"
 
+    def path_generation(self):
+        return self.storage_path / "generation.json"
+
+    def path_schedule(self):
+        return self.storage_path / "schedule.json"
+
+    def path_checkpoint(self):
+        return self.storage_path / "checkpoint.json"
+
+    def path_journal(self, generation):
+        return self.storage_path / f"journal/{generation}.json"
+
+    def path_processed(self):
+        return self.storage_path / "processed.json"
+
+    def path_processor_profile(self):
+        return self.storage_path / "processor_profile.json"
+
     def path_product(self, product_id):
         return self.storage_path / f"products/{product_id}/product.json"
 
@@ -137,6 +680,9 @@ class Storage:
     def path_prices(self, product_id):
         return self.storage_path / f"products/{product_id}/prices.json"
 
+    def path_prices_jsonl(self, product_id):
+        return self.storage_path / f"products/{product_id}/prices.jsonl"
+
     def path_prices_old(self, product_id):
         return self.storage_path / f"products/{product_id}/prices_pre2019.json"
 
@@ -156,6 +702,9 @@ class Storage:
     def path_changelog(self, product_id):
         return self.storage_path / f"products/{product_id}/changes.json"
 
+    def path_changelog_jsonl(self, product_id):
+        return self.storage_path / f"products/{product_id}/changes.jsonl"
+
     @staticmethod
     def make_changelog(json_data):
         return [class_from_json(model.ChangeRecord, entry) for entry in json_data]
@@ -166,6 +715,19 @@ class Storage:
     def path_manifest_v2(self, manifest_id):
         return self.storage_path / f"manifests_v2/{manifest_id[0:2]}/{manifest_id[2:4]}/{manifest_id}.json.gz"
 
+    @staticmethod
+    def key_manifest(manifest_id):
+        return manifest_id
+
+    def path_manifest_index(self, generation):
+        return self.storage_path / f"manifest_index/{generation}.bin"
+
+    def path_pack_manifest_v1(self):
+        return self.storage_path / "packs/manifests_v1"
+
+    def path_pack_manifest_v2(self):
+        return self.storage_path / "packs/manifests_v2"
+
     def path_startpage(self):
         return self.storage_path / "startpage.json"
 
@@ -183,6 +745,12 @@ class Storage:
     def path_user(self, name):
         return self.storage_path / "user" / name
 
+    def path_http_cache(self, cache_key):
+        return self.storage_path / f"httpcache/{cache_key[0:2]}/{cache_key}.json.gz"
+
+    def path_sqlite(self):
+        return self.storage_path / "storage.sqlite3"
+
     def path_indexdb(self):
         return self.storage_path / "index.sqlite3"
 
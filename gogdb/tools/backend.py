@@ -0,0 +1,89 @@
+import sys
+import os
+import asyncio
+
+import quart
+
+from gogdb.core.storage import Storage
+
+"""
+Copies per product items between the file layout and the sqlite backend.
+
+    backend.py import  - files to sqlite
+    backend.py export  - sqlite to files
+"""
+
+
+
+BATCH_SIZE = 1000
+FILE_TABLES = {
+    "product.json": "product",
+    "prices.json": "prices",
+    "prices_pre2019.json": "prices_old",
+    "changes.json": "changelog"
+}
+
+def product_files(storage_path):
+    """Yield (table, path) for every per product item in the file layout"""
+    products_path = storage_path / "products"
+    for prod_dir in sorted(products_path.iterdir()):
+        for filename, table in FILE_TABLES.items():
+            path = prod_dir / filename
+            if path.exists():
+                yield table, path
+        builds_path = prod_dir / "builds"
+        if builds_path.exists():
+            for path in sorted(builds_path.glob("*.json")):
+                yield "repository", path
+
+async def import_files(db):
+    conn = await db.backend.get_connection()
+    num_imported = 0
+    await conn.execute("BEGIN;")
+    for table, path in product_files(db.storage_path):
+        with open(path, "r") as item_file:
+            content = item_file.read()
+        await conn.execute(
+            f"INSERT OR REPLACE INTO {table} (key, content) VALUES (?, ?);",
+            (db.backend.make_key(path), content)
+        )
+        num_imported += 1
+        if num_imported % BATCH_SIZE == 0:
+            await conn.execute("COMMIT;")
+            print(f"Imported {num_imported} items", file=sys.stderr)
+            await conn.execute("BEGIN;")
+    await conn.execute("COMMIT;")
+    print(f"Imported {num_imported} items into {db.path_sqlite()}")
+
+async def export_files(db):
+    conn = await db.backend.get_connection()
+    num_exported = 0
+    for table in sorted(db.backend.tables):
+        async with conn.execute(f"SELECT key, content FROM {table};") as cur:
+            async for key, content in cur:
+                path = db.storage_path / key
+                os.makedirs(path.parent, exist_ok=True)
+                temp_path = str(path) + ".part"
+                with open(temp_path, "w") as item_file:
+                    item_file.write(content)
+                os.replace(src=temp_path, dst=path)
+                num_exported += 1
+    print(f"Exported {num_exported} items to {db.storage_path}")
+
+async def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+    db = Storage(config["STORAGE_PATH"], backend="sqlite")
+
+    command = sys.argv[1:2]
+    if command == ["import"]:
+        await import_files(db)
+        print("Set STORAGE_BACKEND = \"sqlite\" in the config to use the database")
+    elif command == ["export"]:
+        await export_files(db)
+    else:
+        print("Missing command: [import, export]", file=sys.stderr)
+        exit(1)
+    await db.close()
+
+asyncio.run(main())
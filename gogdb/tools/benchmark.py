@@ -0,0 +1,171 @@
+import sys
+import os
+import time
+import random
+import asyncio
+import json
+import dataclasses
+
+import quart
+
+from gogdb.core.storage import Storage, STORAGE_BACKENDS
+import gogdb.core.model as model
+from gogdb.core.dataclsloader import class_from_json, class_from_json_generic
+from gogdb.core.jsonwriter import json_dumps
+from gogdb.updater.updater import create_processors, processors_main
+
+"""
+Benchmarks for storage backends. Run on a copy of production data, results
+depend heavily on whether the page cache is warm.
+
+    benchmark.py manifests [count]
+    benchmark.py processors [processor ...]
+    benchmark.py loader [count]
+    benchmark.py serializer [count]
+
+The processors benchmark overwrites the processor output in the storage directory.
+"""
+
+
+
+def print_result(name, count, duration):
+    print(f"{name:<30} {count:>8} ops {duration:>8.3f} s {count / duration:>10.1f} ops/s")
+
+async def timed(name, func, keys):
+    start_time = time.perf_counter()
+    for key in keys:
+        await func(key)
+    print_result(name, len(keys), time.perf_counter() - start_time)
+
+async def bench_manifests(config, count):
+    db_files = Storage(config["STORAGE_PATH"], manifest_packs=False)
+    db_packs = Storage(config["STORAGE_PATH"], manifest_packs=True)
+
+    manifest_ids = []
+    for dirpath, dirnames, filenames in os.walk(db_files.storage_path / "manifests_v2"):
+        manifest_ids.extend(
+            filename[:-len(".json.gz")] for filename in filenames
+            if filename.endswith(".json.gz")
+        )
+    if not manifest_ids:
+        print("No manifests in the directory layout, run the benchmark before removing them")
+        return
+    sample = random.sample(manifest_ids, min(count, len(manifest_ids)))
+    missing = [f"{random.getrandbits(128):032x}" for i in range(len(sample))]
+    if not await db_packs.manifest_v2.has(sample[0]):
+        print("Manifests are not migrated yet, run packs.py migrate first")
+        return
+
+    for name, db in [("files", db_files), ("packs", db_packs)]:
+        await timed(f"{name} has (existing)", db.manifest_v2.has, sample)
+        await timed(f"{name} has (missing)", db.manifest_v2.has, missing)
+        await timed(f"{name} load", db.manifest_v2.load, sample)
+
+async def bench_processors(config, processor_names):
+    for backend in STORAGE_BACKENDS:
+        db = Storage(config["STORAGE_PATH"], backend=backend)
+        processors = create_processors(db, processor_names)
+        num_ids = len(await db.ids.load())
+        start_time = time.perf_counter()
+        # Without a config the processors run in this process with the benchmarked backend
+        await processors_main(db, processors, {}, processor_names)
+        print_result(f"{backend} processors", num_ids, time.perf_counter() - start_time)
+        await db.close()
+
+def timed_loader(name, loader, cls, fixtures):
+    start_time = time.perf_counter()
+    results = [loader(cls, json_data) for json_data in fixtures]
+    print_result(name, len(fixtures), time.perf_counter() - start_time)
+    return results
+
+async def load_fixtures(config, count):
+    """Load up to count products and their changelogs"""
+    db = Storage.from_config(config)
+    products = []
+    changelogs = []
+    for prod_id in (await db.ids.load())[:count]:
+        product = await db.product.load(prod_id)
+        if product is not None:
+            products.append(product)
+        changelog = await db.changelog.load(prod_id)
+        if changelog is not None:
+            changelogs.append(changelog)
+    await db.close()
+    return products, changelogs
+
+def asdict_encoder(x):
+    """The encoder previously used to save storage items"""
+    if dataclasses.is_dataclass(x):
+        return dataclasses.asdict(x)
+    else:
+        return x.isoformat()
+
+def timed_serializer(name, serializer, fixtures):
+    start_time = time.perf_counter()
+    results = [serializer(obj) for obj in fixtures]
+    print_result(name, len(fixtures), time.perf_counter() - start_time)
+    return results
+
+async def bench_serializer(config, count):
+    products, changelogs = await load_fixtures(config, count)
+    for name, fixtures in [("products", products), ("changelogs", changelogs)]:
+        asdict_res = timed_serializer(
+            f"asdict {name}",
+            lambda obj: json.dumps(
+                obj, indent=2, sort_keys=True, ensure_ascii=False, default=asdict_encoder),
+            fixtures
+        )
+        pretty_res = timed_serializer(f"pretty {name}", json_dumps, fixtures)
+        timed_serializer(f"compact {name}", lambda obj: json_dumps(obj, compact=True), fixtures)
+        if asdict_res != pretty_res:
+            print(f"Pretty output for {name} differs")
+
+async def bench_loader(config, count):
+    db = Storage.from_config(config)
+    # Items without make function return the raw json
+    raw_product = db.backend_item("product", db.path_product)
+    raw_changelog = db.backend_item("changelog", db.path_changelog)
+    ids = (await db.ids.load())[:count]
+    products = []
+    changelog_entries = []
+    for prod_id in ids:
+        product_data = await raw_product.load(prod_id)
+        if product_data is not None:
+            products.append(product_data)
+        changelog_data = await raw_changelog.load(prod_id)
+        if changelog_data is not None:
+            changelog_entries.extend(changelog_data)
+    await db.close()
+
+    for cls, fixtures in [(model.Product, products), (model.ChangeRecord, changelog_entries)]:
+        generic_res = timed_loader(
+            f"generic {cls.__name__}", class_from_json_generic, cls, fixtures)
+        compiled_res = timed_loader(
+            f"compiled {cls.__name__}", class_from_json, cls, fixtures)
+        if generic_res != compiled_res:
+            print(f"Loader results for {cls.__name__} differ")
+
+async def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+
+    benchmark = sys.argv[1:2]
+    if benchmark == ["manifests"]:
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        await bench_manifests(config, count)
+    elif benchmark == ["processors"]:
+        processor_names = sys.argv[2:] or ["index", "startpage", "versions"]
+        await bench_processors(config, processor_names)
+    elif benchmark == ["loader"]:
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        await bench_loader(config, count)
+    elif benchmark == ["serializer"]:
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        await bench_serializer(config, count)
+    else:
+        print(
+            "Missing benchmark name: [manifests, processors, loader, serializer]",
+            file=sys.stderr)
+        exit(1)
+
+asyncio.run(main())
@@ -0,0 +1,85 @@
+import sys
+import os
+import asyncio
+
+import quart
+
+from gogdb.core.storage import Storage, StorageItem, JsonLinesStorageItem
+
+"""
+Converts changelogs between changes.json and the append-only changes.jsonl format.
+
+    changelogs.py convert  - changes.json to changes.jsonl
+    changelogs.py revert   - changes.jsonl to changes.json
+    changelogs.py compact  - rewrite changes.jsonl files, dropping damaged lines
+"""
+
+
+
+async def convert_worker(src_item, dst_item, ids, remove_path_function):
+    num_converted = 0
+    while ids:
+        prod_id = ids.pop()
+        changelog = await src_item.load(prod_id)
+        if changelog is None:
+            continue
+        await dst_item.save(changelog, prod_id)
+        os.remove(remove_path_function(prod_id))
+        num_converted += 1
+    return num_converted
+
+async def compact_worker(jsonl_item, ids):
+    num_damaged = 0
+    while ids:
+        prod_id = ids.pop()
+        path = jsonl_item.path_function(prod_id)
+        try:
+            with open(path, "r") as jsonl_file:
+                num_lines = sum(1 for line in jsonl_file if line.strip())
+        except FileNotFoundError:
+            continue
+        changelog = await jsonl_item.load(prod_id)
+        if len(changelog) != num_lines:
+            print(f"Dropping {num_lines - len(changelog)} damaged lines of {prod_id}")
+            num_damaged += 1
+            await jsonl_item.save(changelog, prod_id)
+    return num_damaged
+
+async def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+    db = Storage(config["STORAGE_PATH"])
+    ids = await db.ids.load()
+    # No make function, entries are copied as raw json
+    json_item = StorageItem(db.path_changelog)
+    jsonl_item = JsonLinesStorageItem(db.path_changelog_jsonl)
+
+    command = sys.argv[1:2]
+    if command == ["convert"]:
+        worker_tasks = [
+            asyncio.create_task(convert_worker(json_item, jsonl_item, ids, db.path_changelog))
+            for worker_num in range(8)
+        ]
+        num_converted = sum(await asyncio.gather(*worker_tasks))
+        print(f"Converted {num_converted} changelogs")
+        print("Set STORAGE_CHANGELOG_JSONL = True in the config to use them")
+    elif command == ["revert"]:
+        worker_tasks = [
+            asyncio.create_task(convert_worker(jsonl_item, json_item, ids, db.path_changelog_jsonl))
+            for worker_num in range(8)
+        ]
+        num_converted = sum(await asyncio.gather(*worker_tasks))
+        print(f"Reverted {num_converted} changelogs")
+    elif command == ["compact"]:
+        worker_tasks = [
+            asyncio.create_task(compact_worker(jsonl_item, ids))
+            for worker_num in range(8)
+        ]
+        num_damaged = sum(await asyncio.gather(*worker_tasks))
+        print(f"Compacted {num_damaged} damaged changelogs")
+    else:
+        print("Missing command: [convert, revert, compact]", file=sys.stderr)
+        exit(1)
+    await db.close()
+
+asyncio.run(main())
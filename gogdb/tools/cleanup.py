@@ -105,12 +105,14 @@ async def cleanup_worker(db, ids, worker_num):
 async def main():
     config = quart.Config(".")
     config.from_envvar("GOGDB_CONFIG")
-    db = Storage(config["STORAGE_PATH"])
+    db = Storage.from_config(config)
     ids = await db.ids.load()
     worker_tasks = [
         asyncio.create_task(cleanup_worker(db, ids, worker_num))
         for worker_num in range(8)
     ]
     await asyncio.gather(*worker_tasks, return_exceptions=False)
+    await db.bump_generation()
+    await db.close()
 
 asyncio.run(main())
@@ -0,0 +1,49 @@
+import sys
+import os
+
+import quart
+
+from gogdb.core.storage import Storage
+from gogdb.core.packfile import PackFile
+from gogdb.core.manifestindex import ManifestIndex
+
+"""
+Rebuilds the index of known manifest ids from the stored manifests.
+
+    manifestindex.py rebuild
+"""
+
+
+
+def manifest_file_ids(manifests_path):
+    for dirpath, dirnames, filenames in os.walk(manifests_path):
+        for filename in filenames:
+            if filename.endswith(".json.gz"):
+                yield filename[:-len(".json.gz")]
+
+def stored_manifest_ids(manifests_path, pack):
+    """Ids in both the directory layout and the pack, the updater might use either"""
+    yield from manifest_file_ids(manifests_path)
+    yield from pack.keys()
+
+def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+    db = Storage(config["STORAGE_PATH"])
+    generations = [
+        ("v1", db.storage_path / "manifests_v1", PackFile(db.path_pack_manifest_v1())),
+        ("v2", db.storage_path / "manifests_v2", PackFile(db.path_pack_manifest_v2()))
+    ]
+
+    command = sys.argv[1:2]
+    if command == ["rebuild"]:
+        for generation, manifests_path, pack in generations:
+            index = ManifestIndex(db.path_manifest_index(generation))
+            num_entries = index.rebuild(stored_manifest_ids(manifests_path, pack))
+            print(f"Rebuilt manifest index {generation} with {num_entries} entries")
+        print("Set STORAGE_MANIFEST_INDEX = True in the config to use it")
+    else:
+        print("Missing command: [rebuild]", file=sys.stderr)
+        exit(1)
+
+main()
@@ -0,0 +1,87 @@
+import sys
+import os
+
+import quart
+
+from gogdb.core.storage import Storage
+from gogdb.core.packfile import PackFile
+
+"""
+Moves manifests from the directory layout into packs and repairs pack indexes.
+
+    packs.py migrate [--remove]
+    packs.py repair
+"""
+
+
+
+BATCH_SIZE = 1000
+
+def manifest_files(manifests_path):
+    """Yield (manifest_id, path) for every manifest in the sharded directory layout"""
+    for dirpath, dirnames, filenames in os.walk(manifests_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".json.gz"):
+                yield filename[:-len(".json.gz")], os.path.join(dirpath, filename)
+
+def migrate(manifests_path, pack, remove):
+    num_migrated = 0
+    num_skipped = 0
+    batch = []
+    batch_paths = []
+
+    def flush():
+        pack.put_many(batch)
+        if remove:
+            # Only delete the originals once the records are on disk
+            pack.sync()
+            for path in batch_paths:
+                os.remove(path)
+        batch.clear()
+        batch_paths.clear()
+
+    if remove:
+        # Records that already exist might have been written without a sync
+        pack.sync()
+    for manifest_id, path in manifest_files(manifests_path):
+        if pack.has(manifest_id):
+            num_skipped += 1
+            if remove:
+                os.remove(path)
+            continue
+        # Files already contain the same gzipped json stored in packs
+        with open(path, "rb") as manifest_file:
+            batch.append((manifest_id, manifest_file.read()))
+        batch_paths.append(path)
+        num_migrated += 1
+        if len(batch) >= BATCH_SIZE:
+            flush()
+            print(f"Migrated {num_migrated} manifests from {manifests_path}", file=sys.stderr)
+    flush()
+    print(f"Migrated {num_migrated} manifests, skipped {num_skipped} existing from {manifests_path}")
+
+def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+    db = Storage(config["STORAGE_PATH"])
+    packs = [
+        (db.storage_path / "manifests_v1", PackFile(db.path_pack_manifest_v1())),
+        (db.storage_path / "manifests_v2", PackFile(db.path_pack_manifest_v2()))
+    ]
+
+    command = sys.argv[1:2]
+    if command == ["migrate"]:
+        remove = "--remove" in sys.argv[2:]
+        for manifests_path, pack in packs:
+            migrate(manifests_path, pack, remove)
+        print("Set STORAGE_MANIFEST_PACKS = True in the config to use the packs")
+    elif command == ["repair"]:
+        for manifests_path, pack in packs:
+            num_entries = pack.rebuild_index()
+            print(f"Rebuilt index of {pack.path} with {num_entries} entries")
+    else:
+        print("Missing command: [migrate [--remove], repair]", file=sys.stderr)
+        exit(1)
+
+main()
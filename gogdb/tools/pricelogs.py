@@ -0,0 +1,93 @@
+import sys
+import os
+import asyncio
+
+import quart
+
+from gogdb.core.storage import Storage, StorageItem, PriceLogStorageItem
+
+"""
+Converts price logs between prices.json and the append-only prices.jsonl format.
+
+    pricelogs.py convert  - prices.json to prices.jsonl
+    pricelogs.py revert   - prices.jsonl to prices.json
+    pricelogs.py compact  - rewrite prices.jsonl files, dropping damaged lines
+"""
+
+
+
+def count_records(price_log):
+    return sum(
+        len(currency_log)
+        for country_log in price_log.values()
+        for currency_log in country_log.values()
+    )
+
+async def convert_worker(src_item, dst_item, ids, remove_path_function):
+    num_converted = 0
+    while ids:
+        prod_id = ids.pop()
+        price_log = await src_item.load(prod_id)
+        if price_log is None:
+            continue
+        await dst_item.save(price_log, prod_id)
+        os.remove(remove_path_function(prod_id))
+        num_converted += 1
+    return num_converted
+
+async def compact_worker(jsonl_item, ids):
+    num_damaged = 0
+    while ids:
+        prod_id = ids.pop()
+        path = jsonl_item.path_function(prod_id)
+        try:
+            with open(path, "r") as jsonl_file:
+                num_lines = sum(1 for line in jsonl_file if line.strip())
+        except FileNotFoundError:
+            continue
+        price_log = await jsonl_item.load(prod_id)
+        num_records = count_records(price_log)
+        if num_records != num_lines:
+            print(f"Dropping {num_lines - num_records} damaged lines of {prod_id}")
+            num_damaged += 1
+            await jsonl_item.save(price_log, prod_id)
+    return num_damaged
+
+async def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+    db = Storage(config["STORAGE_PATH"])
+    ids = await db.ids.load()
+    # No make function, records are copied as raw json
+    json_item = StorageItem(db.path_prices)
+    jsonl_item = PriceLogStorageItem(db.path_prices_jsonl)
+
+    command = sys.argv[1:2]
+    if command == ["convert"]:
+        worker_tasks = [
+            asyncio.create_task(convert_worker(json_item, jsonl_item, ids, db.path_prices))
+            for worker_num in range(8)
+        ]
+        num_converted = sum(await asyncio.gather(*worker_tasks))
+        print(f"Converted {num_converted} price logs")
+        print("Set STORAGE_PRICES_JSONL = True in the config to use them")
+    elif command == ["revert"]:
+        worker_tasks = [
+            asyncio.create_task(convert_worker(jsonl_item, json_item, ids, db.path_prices_jsonl))
+            for worker_num in range(8)
+        ]
+        num_converted = sum(await asyncio.gather(*worker_tasks))
+        print(f"Reverted {num_converted} price logs")
+    elif command == ["compact"]:
+        worker_tasks = [
+            asyncio.create_task(compact_worker(jsonl_item, ids))
+            for worker_num in range(8)
+        ]
+        num_damaged = sum(await asyncio.gather(*worker_tasks))
+        print(f"Compacted {num_damaged} damaged price logs")
+    else:
+        print("Missing command: [convert, revert, compact]", file=sys.stderr)
+        exit(1)
+    await db.close()
+
+asyncio.run(main())
@@ -59,6 +59,7 @@ def format_date_timestamp(ts):
 
 class ChartsProcessor:
     wants = {"prices"}
+    incremental = {"prices"}
 
     def __init__(self, db):
         self.db = db
@@ -66,6 +67,10 @@ class ChartsProcessor:
     async def prepare(self):
         pass
 
+    async def prepare_incremental(self, ids):
+        # Charts of unchanged products stay as they are
+        return True
+
     async def process(self, data):
         if data.prices is None or not data.prices["US"]["USD"]:
             return
@@ -140,5 +145,12 @@ class ChartsProcessor:
             async with aiofiles.open(chart_path, "wb") as fobj:
                 await fobj.write(chart_compressed)
 
+    def get_partial(self):
+        # Charts are written by the worker processes themselves
+        return None
+
+    async def merge(self, partial):
+        pass
+
     async def finish(self):
         pass
@@ -1,7 +1,8 @@
 import collections
 
 class DependenciesProcessor:
-    wants = {"product"}
+    wants = {"product", "repositories"}
+    incremental = {"product", "repositories"}
 
     def __init__(self, db):
         self.db = db
@@ -10,6 +11,16 @@ class DependenciesProcessor:
     async def prepare(self):
         pass
 
+    async def prepare_incremental(self, ids):
+        dependency_map = await self.db.user.load("dependencies.json")
+        if dependency_map is None:
+            return False
+        for dependency, game_list in dependency_map.items():
+            unchanged_games = [game for game in game_list if game["id"] not in ids]
+            if unchanged_games:
+                self.dependency_map[dependency] = unchanged_games
+        return True
+
     async def process(self, data):
         prod = data.product
         if prod is None:
@@ -20,12 +31,19 @@ class DependenciesProcessor:
         ]
         if win_builds:
             latest_build = win_builds[-1]
-            repo = await self.db.repository.load(prod.id, latest_build.id)
+            repo = await data.repositories.load(latest_build.id)
             if repo is None:
                 return
             for dependency in repo.get("dependencies", []):
                 self.dependency_map[dependency].append({"id": prod.id, "title": prod.title})
 
+    def get_partial(self):
+        return dict(self.dependency_map)
+
+    async def merge(self, partial):
+        for dependency, game_list in partial.items():
+            self.dependency_map[dependency].extend(game_list)
+
     async def finish(self):
         for game_list in self.dependency_map.values():
             game_list.sort(key=lambda x: x["id"])
@@ -7,7 +7,7 @@ import aiofiles
 logger = logging.getLogger("UpdateDB.filelist")
 
 class FilelistProcessor:
-    wants = {"product"}
+    wants = {"product", "repositories", "manifests"}
 
     def __init__(self, db):
         self.db = db
@@ -37,11 +37,11 @@ class FilelistProcessor:
         ]
         game_files = []
         for build in win_builds:
-            repo = await self.db.repository.load(prod.id, build.id)
+            repo = await data.repositories.load(build.id)
             if repo is None:
                 return
             for depot in repo.get("depots", []):
-                manifest = await self.db.manifest_v2.load(depot["manifest"])
+                manifest = await data.manifests.load(depot["manifest"])
                 for item in manifest["depot"]["items"]:
                     if item["type"] == "DepotFile":
                         game_files.append((item["path"], build.version, prod.title))
@@ -1,16 +1,19 @@
 import pathlib
 import logging
 import json
-import zlib
 import os
 import traceback
 import asyncio
+import collections
+import hashlib
+import urllib.parse
 
 import aiohttp
 import aiofiles
 
 import gogdb.core.storage as storage
-from gogdb.updater.gogtoken import GogToken
+from gogdb.updater.gogtoken import GogToken, SharedToken
+from gogdb.updater.ratecontrol import RateControl, DEFAULT_MAX_LIMIT, backoff_delay
 
 
 
@@ -24,22 +27,56 @@ CACHE_STORE = 1     # Download and store to disk
 CACHE_LOAD = 2      # Only load from disk
 CACHE_FALLBACK = 3  # Try to load, on failure fall back to store
 
+# Returned by get_json when the server answered 304 Not Modified
+NOT_MODIFIED = object()
+# Returned instead of None for a 404 if it was expected, to tell it apart from request errors
+NOT_FOUND = object()
+
 logger = logging.getLogger("UpdateDB.session")
 
 def short_exception(e):
     return traceback.format_exception_only(e)[-1].strip()
 
+def http_cache_key(url, params=None):
+    if params:
+        url = url + "?" + urllib.parse.urlencode(sorted(params.items()))
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+class ValidatedContent(dict):
+    """
+    Response json together with its ETag and Last-Modified validators. If not_modified is
+    set the server answered 304 and the content is the stored copy from an earlier run.
+    """
+    def __init__(self, content, cache_key, validators, not_modified):
+        super().__init__(content)
+        self.cache_key = cache_key
+        self.etag = validators.get("etag")
+        self.last_modified = validators.get("last_modified")
+        self.not_modified = not_modified
+
+def is_not_modified(*contents):
+    return all(
+        isinstance(content, ValidatedContent) and content.not_modified
+        for content in contents
+    )
+
 class GogSession:
     def __init__(self, db, config):
         self.db = db
         self.config = config
         self.storage_path = pathlib.Path(config["STORAGE_PATH"])
-        aio_connector = aiohttp.TCPConnector(limit=100, limit_per_host=10)
+        # Concurrency per host is limited by the rate control instead
+        aio_connector = aiohttp.TCPConnector(limit=0)
         headers = {"User-Agent": USER_AGENT}
         self.aio_session = aiohttp.ClientSession(
             connector=aio_connector, headers=headers)
         self.set_cookie("gog_lc", "US_USD_en-US")
         self.token = None # Needs to be loaded with load_token
+        self.rate_control = RateControl(config.get("HOST_MAX_CONCURRENCY", DEFAULT_MAX_LIMIT))
+        self.revalidate = config.get("HTTP_REVALIDATE", False)
+        self.num_not_modified = 0
+        # Response body sizes by the kind passed to get_json
+        self.bytes_received = collections.Counter()
 
     async def load_token(self):
         self.token = GogToken(self.aio_session)
@@ -48,85 +85,120 @@ class GogSession:
     async def save_token(self):
         await self.db.token.save(self.token.get_data())
 
+    def set_shared_token(self, token_data):
+        """Use a token that another process refreshes"""
+        if self.token is None:
+            self.token = SharedToken(self.aio_session)
+        self.token.set_data(token_data)
+
     def set_cookie(self, name, value):
         self.aio_session.cookie_jar.update_cookies({name: value})
 
     async def close(self):
         await self.aio_session.close()
 
-    async def get_json(self, name, url, headers=None, timeout_sec=10, decompress=False, expect_404=False, **kwargs):
+    async def get_json(self, name, url, headers=None, timeout_sec=10, decompress=False, expect_404=False, validators=None, kind=None, **kwargs):
+        """
+        If validators is given, the request is conditional on the stored etag and
+        last_modified, and the validators of the response get written back to it.
+        """
         if await self.token.refresh_if_expired():
             await self.save_token()
 
         if headers is None:
             headers = {}
         headers["Authorization"] = "Bearer " + self.token.access_token
+        if validators is not None:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
         # Set default timeout
         timeout = aiohttp.ClientTimeout(total=timeout_sec)
         retries = REQUEST_RETRIES
+        attempt = 0
         while retries > 0:
             retries -= 1
-            try:
-                resp = await self.aio_session.get(url, headers=headers, timeout=timeout, **kwargs)
-            except (TimeoutError, aiohttp.ClientError) as e:
-                if retries == 0:
-                    logger.error("Failed to request %s: %s", name, short_exception(e))
-                    return
-                else:
-                    continue
-            except Exception as e:
-                logger.error("Failed to request %s: %s", name, short_exception(e))
-                return
-
-            if 200 <= resp.status < 300:
+            if attempt > 0:
+                await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+            async with self.rate_control.slot(url) as slot:
                 try:
-                    if decompress:
-                        content_comp = await resp.read()
-                        content_binary = zlib.decompress(content_comp, wbits=15)
-                        content_text = content_binary.decode("utf-8")
-                    else:
-                        content_text = await resp.text()
+                    resp = await self.aio_session.get(url, headers=headers, timeout=timeout, **kwargs)
                 except (TimeoutError, aiohttp.ClientError) as e:
+                    slot.failure()
                     if retries == 0:
-                        logger.error(
-                            "Failed to read request body of %s: %s", name, short_exception(e)
-                        )
+                        logger.error("Failed to request %s: %s", name, short_exception(e))
                         return
                     else:
                         continue
                 except Exception as e:
-                    logger.error("Failed to read request body of %s: %s", name, short_exception(e))
+                    logger.error("Failed to request %s: %s", name, short_exception(e))
                     return
+                slot.response(resp.status, resp.headers)
 
-                try:
-                    content_json = json.loads(content_text)
-                except json.JSONDecodeError as e:
-                    if retries == 0:
+                if 200 <= resp.status < 300:
+                    try:
+                        if decompress:
+                            content_comp = await resp.read()
+                            content_binary = await self.db.codec.zlib_decompress(content_comp, wbits=15)
+                            content_text = content_binary.decode("utf-8")
+                        else:
+                            content_text = await resp.text()
+                    except (TimeoutError, aiohttp.ClientError) as e:
+                        slot.failure()
+                        if retries == 0:
+                            logger.error(
+                                "Failed to read request body of %s: %s", name, short_exception(e)
+                            )
+                            return
+                        else:
+                            continue
+                    except Exception as e:
+                        logger.error("Failed to read request body of %s: %s", name, short_exception(e))
+                        return
+
+                    try:
+                        content_json = await self.db.codec.json_loads(content_text)
+                    except json.JSONDecodeError as e:
+                        slot.failure()
+                        if retries == 0:
+                            logger.error("Failed to decode json of %s: %s", name, short_exception(e))
+                            return
+                        else:
+                            continue
+                    except Exception as e:
                         logger.error("Failed to decode json of %s: %s", name, short_exception(e))
                         return
-                    else:
-                        continue
-                except Exception as e:
-                    logger.error("Failed to decode json of %s: %s", name, short_exception(e))
+                    if kind is not None:
+                        # The body is already buffered, this doesn't read it again
+                        self.bytes_received[kind] += len(await resp.read())
+                    if validators is not None:
+                        validators["etag"] = resp.headers.get("ETag")
+                        validators["last_modified"] = resp.headers.get("Last-Modified")
+                    return content_json
+
+                elif resp.status == 304 and validators is not None:
+                    logger.debug("Request for %s not modified", name)
+                    await resp.read()
+                    return NOT_MODIFIED
+
+                # Treat 404s as info because they are so common
+                elif resp.status == 404 and expect_404:
+                    logger.info("Request for %s returned %s", name, resp.status)
+                    await resp.read()
+                    return NOT_FOUND
+                # Status 400 is more likely to be a server error than a client error, retry
+                # 408 is request timeout, 429 is rate limiting
+                elif 401 <= resp.status < 500 and resp.status not in (408, 429):
+                    logger.error("Request for %s returned %s", name, resp.status)
+                    await resp.read()
                     return
-                return content_json
-
-            # Treat 404s as info because they are so common
-            elif resp.status == 404 and expect_404:
-                logger.info("Request for %s returned %s", name, resp.status)
-                await resp.read()
-                return
-            # Status 400 is more likely to be a server error than a client error, retry
-            # 408 is request timeout
-            elif 401 <= resp.status < 500 and resp.status != 408:
-                logger.error("Request for %s returned %s", name, resp.status)
-                await resp.read()
-                return
 
         logger.error("Request for %s returned %s", name, resp.status)
         # Function regularly ends with `return content_json`
 
-    async def get_json_cached(self, name, url, path, caching=CACHE_NONE, **kwargs):
+    async def get_json_cached(self, name, url, path, caching=CACHE_NONE, revalidate=False, **kwargs):
         if "params" in kwargs:
             logger.debug("Requesting %r %r", url, kwargs["params"])
         else:
@@ -142,9 +214,12 @@ class GogSession:
                 else:
                     pass # Continue downloading
 
-        content_json = await self.get_json(name, url, **kwargs)
-        if content_json is None:
-            return
+        if revalidate and self.revalidate:
+            content_json = await self.get_json_revalidated(name, url, **kwargs)
+        else:
+            content_json = await self.get_json(name, url, **kwargs)
+        if content_json is None or content_json is NOT_FOUND:
+            return content_json
 
         if caching & CACHE_STORE:
             path.parent.mkdir(parents=True, exist_ok=True)
@@ -157,12 +232,45 @@ class GogSession:
 
         return content_json
 
+    async def get_json_revalidated(self, name, url, **kwargs):
+        cache_key = http_cache_key(url, kwargs.get("params"))
+        cache_entry = await self.db.http_cache.load(cache_key)
+        validators = {}
+        if cache_entry is not None:
+            validators["etag"] = cache_entry["etag"]
+            validators["last_modified"] = cache_entry["last_modified"]
+        content_json = await self.get_json(name, url, validators=validators, **kwargs)
+        if content_json is NOT_MODIFIED:
+            self.num_not_modified += 1
+            return ValidatedContent(cache_entry["content"], cache_key, validators, True)
+        if not isinstance(content_json, dict):
+            return content_json
+        if not validators.get("etag") and not validators.get("last_modified"):
+            return content_json
+        return ValidatedContent(content_json, cache_key, validators, False)
+
+    async def store_validators(self, *contents):
+        """
+        Remember the validators of responses. Only call this once their content has been
+        stored, a later 304 means the stored data is already up to date.
+        """
+        for content in contents:
+            if not isinstance(content, ValidatedContent) or content.not_modified:
+                continue
+            cache_entry = {
+                "etag": content.etag,
+                "last_modified": content.last_modified,
+                "content": dict(content)
+            }
+            await self.db.http_cache.save(cache_entry, content.cache_key)
+
     async def fetch_product_v0(self, prod_id):
         return await self.get_json_cached(
             f"api v0 {prod_id}",
             url=f"https://api.gog.com/products/{prod_id}?expand=downloads,expanded_dlcs,description,screenshots,videos,related_products,changelog&locale=en-US",
             path=self.storage_path / f"raw/prod_v0/{prod_id}_v0.json",
             caching=self.config.get("CACHE_PRODUCT_V0", CACHE_NONE),
+            revalidate=True,
             expect_404=True
         )
 
@@ -172,6 +280,7 @@ class GogSession:
             url=f"https://api.gog.com/v2/games/{prod_id}?locale=en-US",
             path=self.storage_path / f"raw/prod_v2/{prod_id}_v2.json",
             caching=self.config.get("CACHE_PRODUCT_V2", CACHE_NONE),
+            revalidate=True,
             expect_404=True
         )
 
@@ -180,7 +289,8 @@ class GogSession:
             f"api v0 {prod_id}",
             url=f"https://content-system.gog.com/products/{prod_id}/os/{system}/builds?generation=2",
             path=self.storage_path / f"raw/builds/{prod_id}_builds_{system}.json",
-            caching=self.config.get("CACHE_BUILDS", CACHE_NONE)
+            caching=self.config.get("CACHE_BUILDS", CACHE_NONE),
+            revalidate=True
         )
 
     async def fetch_repo_v1(self, repo_url, prod_id, build_id):
@@ -196,7 +306,8 @@ class GogSession:
             f"manifest v1 {mf_name}",
             url=manifest_url,
             path=None,
-            caching=CACHE_NONE
+            caching=CACHE_NONE,
+            kind="manifest"
         )
 
     async def fetch_repo_v2(self, repo_url, prod_id, build_id):
@@ -216,7 +327,8 @@ class GogSession:
             url=manifest_url,
             path=None,
             caching=CACHE_NONE,
-            decompress=True
+            decompress=True,
+            kind="manifest"
         )
 
     async def fetch_catalog(self, params, page_num):
@@ -227,5 +339,6 @@ class GogSession:
             url="https://catalog.gog.com/v1/catalog",
             params=page_params,
             path=self.storage_path / f"raw/catalog/page_{cache_id}.json",
-            caching=self.config.get("CACHE_CATALOG", CACHE_NONE)
+            caching=self.config.get("CACHE_CATALOG", CACHE_NONE),
+            revalidate=True
         )
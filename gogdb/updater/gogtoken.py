@@ -120,6 +120,11 @@ class GogToken:
     def __repr__(self):
         return repr(self.__dict__)
 
+class SharedToken(GogToken):
+    """Token refreshed by another process, which passes on the new data to set_data"""
+    async def refresh_if_expired(self, refresh_token=None, margin=timedelta(seconds=60)):
+        return False
+
 async def main():
     import re
     import sys
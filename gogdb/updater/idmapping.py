@@ -4,6 +4,7 @@ logger = logging.getLogger("UpdateDB.idmapping")
 
 class IdMappingProcessor:
     wants = {"product"}
+    incremental = {"product"}
 
     def __init__(self, db):
         self.db = db
@@ -13,6 +14,20 @@ class IdMappingProcessor:
     async def prepare(self):
         pass
 
+    async def prepare_incremental(self, ids):
+        store_to_id = await self.db.user.load("store_to_id.json")
+        id_to_store = await self.db.user.load("id_to_store.json")
+        if store_to_id is None or id_to_store is None:
+            return False
+        self.store_to_id = {
+            slug: prod_id for slug, prod_id in store_to_id.items() if prod_id not in ids
+        }
+        # Keys of json objects are strings
+        self.id_to_store = {
+            int(prod_key): slug for prod_key, slug in id_to_store.items() if int(prod_key) not in ids
+        }
+        return True
+
     async def process(self, data):
         product = data.product
         if product is None:
@@ -23,6 +38,14 @@ class IdMappingProcessor:
             self.store_to_id[product.slug] = product.id
             self.id_to_store[product.id] = product.slug
 
+    def get_partial(self):
+        return (self.store_to_id, self.id_to_store)
+
+    async def merge(self, partial):
+        store_to_id, id_to_store = partial
+        self.store_to_id.update(store_to_id)
+        self.id_to_store.update(id_to_store)
+
     async def finish(self):
         await self.db.user.save(self.store_to_id, "store_to_id.json")
         await self.db.user.save(self.id_to_store, "id_to_store.json")
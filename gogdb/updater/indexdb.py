@@ -3,6 +3,8 @@ import dataclasses
 import os
 import collections
 import logging
+import shutil
+import asyncio
 
 import aiosqlite
 
@@ -49,25 +51,22 @@ async def count_rows(cur, table_name):
     await cur.execute(f"SELECT COUNT(*) FROM {table_name};")
     return (await cur.fetchone())[0]
 
-async def index_product(prod, cur):
+def product_row(prod):
     if prod.rank_bestselling is not None:
         sale_rank = prod.rank_bestselling
     else:
         sale_rank = 100000  # some high number
-    await cur.execute(
-        "INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (
-            prod.id,
-            prod.title,
-            prod.image_logo,
-            prod.type,
-            compress_systems(prod.comp_systems),
-            sale_rank,
-            normalize_search(prod.title)
-        )
+    return (
+        prod.id,
+        prod.title,
+        prod.image_logo,
+        prod.type,
+        compress_systems(prod.comp_systems),
+        sale_rank,
+        normalize_search(prod.title)
     )
 
-async def index_changelog(prod, changelog, cur):
+def changelog_rows(prod, changelog, rows):
     summaries = collections.defaultdict(set)
     for changerec in changelog:
         idx_change = model.IndexChange(
@@ -88,39 +87,44 @@ async def index_changelog(prod, changelog, cur):
         elif changerec.category == "property":
             idx_change.property_name = changerec.property_record.property_name
 
-        await cur.execute(
-            "INSERT INTO changelog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                idx_change.id,
-                idx_change.title,
-                idx_change.timestamp.timestamp(),
-                idx_change.action,
-                idx_change.category,
-                idx_change.dl_type,
-                idx_change.bonus_type,
-                idx_change.property_name,
-                json.dumps(
-                    idx_change.record, sort_keys=True, ensure_ascii=False,
-                    default=storage.json_encoder)
-            )
-        )
+        rows["changelog"].append((
+            idx_change.id,
+            idx_change.title,
+            idx_change.timestamp.timestamp(),
+            idx_change.action,
+            idx_change.category,
+            idx_change.dl_type,
+            idx_change.bonus_type,
+            idx_change.property_name,
+            json.dumps(
+                idx_change.record, sort_keys=True, ensure_ascii=False,
+                default=storage.json_encoder)
+        ))
 
         summaries[changerec.timestamp].add(changerec.category)
 
     for timestamp, category_set in summaries.items():
         category_str = ",".join(sorted(category_set))
-        await cur.execute(
-            "INSERT INTO changelog_summary VALUES (?, ?, ?, ?)",
-            (
-                prod.id,
-                prod.title,
-                timestamp.timestamp(),
-                category_str
-            )
-        )
+        rows["changelog_summary"].append((
+            prod.id,
+            prod.title,
+            timestamp.timestamp(),
+            category_str
+        ))
+
+def empty_rows():
+    return {"products": [], "changelog": [], "changelog_summary": []}
+
+async def insert_rows(cur, rows):
+    for table, table_rows in rows.items():
+        if not table_rows:
+            continue
+        placeholders = ", ".join(["?"] * len(table_rows[0]))
+        await cur.executemany(f"INSERT INTO {table} VALUES ({placeholders})", table_rows)
 
 class IndexDbProcessor:
     wants = {"product", "changelog"}
+    incremental = {"product", "changelog"}
 
     def __init__(self, db):
         self.db = db
@@ -128,6 +132,8 @@ class IndexDbProcessor:
         self.indexdb_path_part = self.indexdb_path.with_name(self.indexdb_path.name + ".part")
         self.conn = None
         self.cur = None
+        # Rows collected by a worker process, which doesn't open the database
+        self.partial_rows = empty_rows()
 
     async def prepare(self):
         self.indexdb_path.parent.mkdir(exist_ok=True)
@@ -141,14 +147,43 @@ class IndexDbProcessor:
         await self.cur.execute("DELETE FROM changelog;")
         await self.cur.execute("DELETE FROM changelog_summary;")
 
+    async def prepare_incremental(self, ids):
+        """Start from the current index without the rows of the changed products"""
+        if not self.indexdb_path.exists():
+            return False
+        self.indexdb_path_part.unlink(missing_ok=True)
+        await asyncio.to_thread(shutil.copyfile, self.indexdb_path, self.indexdb_path_part)
+        self.conn = await aiosqlite.connect(self.indexdb_path_part, isolation_level=None)
+        self.cur = await self.conn.cursor()
+
+        await self.cur.execute("BEGIN TRANSACTION;")
+        await self.cur.execute("CREATE TEMP TABLE changed_ids (product_id INTEGER PRIMARY KEY);")
+        await self.cur.executemany(
+            "INSERT INTO changed_ids VALUES (?)", [(prod_id,) for prod_id in ids])
+        for table in ["products", "changelog", "changelog_summary"]:
+            await self.cur.execute(
+                f"DELETE FROM {table} WHERE product_id IN (SELECT product_id FROM changed_ids);")
+        return True
+
     async def process(self, data):
         if data.product is None:
             return
-        await index_product(data.product, self.cur)
-
-        if data.changelog is None:
-            return
-        await index_changelog(data.product, data.changelog, self.cur)
+        rows = empty_rows()
+        rows["products"].append(product_row(data.product))
+        if data.changelog is not None:
+            changelog_rows(data.product, data.changelog, rows)
+
+        if self.cur is None:
+            for table, table_rows in rows.items():
+                self.partial_rows[table].extend(table_rows)
+        else:
+            await insert_rows(self.cur, rows)
+
+    def get_partial(self):
+        return self.partial_rows
+
+    async def merge(self, partial):
+        await insert_rows(self.cur, partial)
 
     async def finish(self):
         await self.cur.execute("END TRANSACTION;")
@@ -0,0 +1,58 @@
+"""
+Journal of the products changed by download runs, so processors can skip the
+products that didn't change since they last ran.
+
+Every download run saves the IDs of the products whose product data, changelog,
+prices or repositories changed, together with which of these items changed, as
+journal/<generation>.json. Processors remember the generation they processed
+last. In incremental mode a processor supporting it only processes the products
+from the journals since then, with a journal missing it processes all products.
+"""
+
+import collections
+
+
+
+# Journals of older runs are deleted, processors that didn't run since then do a full run
+KEEP_JOURNALS = 100
+
+class DirtyJournal:
+    def __init__(self):
+        # Product id to the names of the changed storage items
+        self.changed = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self.changed)
+
+    def mark(self, prod_id, item):
+        self.changed[prod_id].add(item)
+
+    def to_json(self):
+        return {str(prod_id): sorted(items) for prod_id, items in self.changed.items()}
+
+    def update_json(self, journal_json):
+        for prod_key, items in journal_json.items():
+            self.changed[int(prod_key)].update(items)
+
+    def ids_with(self, items):
+        """Products with a change to any of the given items"""
+        return set(prod_id for prod_id, changed_items in self.changed.items() if changed_items & items)
+
+
+async def save_journal(db, journal, generation):
+    await db.journal.save(journal.to_json(), generation)
+    if generation > KEEP_JOURNALS:
+        await db.journal.remove(generation - KEEP_JOURNALS)
+
+async def load_changes(db, since_generation, generation):
+    """Merge the journals of the runs after since_generation, None if one of them is missing"""
+    journal = DirtyJournal()
+    for journal_generation in range(since_generation + 1, generation + 1):
+        journal_json = await db.journal.load(journal_generation)
+        if journal_json is None:
+            return None
+        journal.update_json(journal_json)
+    return journal
+
+def processor_name(processor):
+    return type(processor).__name__
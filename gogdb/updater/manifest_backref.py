@@ -1,7 +1,8 @@
 import collections
 
 class BackrefProcessor:
-    wants = {"product"}
+    wants = {"product", "repositories"}
+    incremental = {"product", "repositories"}
 
     def __init__(self, db):
         self.db = db
@@ -10,6 +11,16 @@ class BackrefProcessor:
     async def prepare(self):
         pass
 
+    async def prepare_incremental(self, ids):
+        manifest_map = await self.db.user.load("manifest_backref.json")
+        if manifest_map is None:
+            return False
+        self.manifest_map = {
+            manifest_id: backref for manifest_id, backref in manifest_map.items()
+            if backref["prod_id"] not in ids
+        }
+        return True
+
     async def process(self, data):
         prod = data.product
         if prod is None:
@@ -19,11 +30,17 @@ class BackrefProcessor:
             if build.os == "windows" and build.generation == 2
         ]
         for build in win_builds:
-            repo = await self.db.repository.load(prod.id, build.id)
+            repo = await data.repositories.load(build.id)
             if repo is None:
                 return
             for depot in repo.get("depots", []):
                 self.manifest_map[depot["manifest"]] = {"title": prod.title, "prod_id": prod.id, "build_id": build.id}
 
+    def get_partial(self):
+        return self.manifest_map
+
+    async def merge(self, partial):
+        self.manifest_map.update(partial)
+
     async def finish(self):
         await self.db.user.save(self.manifest_map, "manifest_backref.json")
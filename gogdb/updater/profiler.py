@@ -0,0 +1,161 @@
+"""
+Timing and memory profile of the processors.
+
+With profiling enabled every process call and every load of a product item is
+timed. For each processor the report lists the total and percentile time of its
+process calls, the slowest products, the time of its finish step and the
+highest tracemalloc peak of a single call. Times and peaks are only accurate if
+no other code runs while a call is suspended, so profiling runs a single
+processor worker per process. Tracing memory makes processing several times
+slower.
+"""
+
+import collections
+import heapq
+import time
+import tracemalloc
+
+from gogdb.updater.journal import processor_name
+
+
+
+# Number of slowest products listed per processor
+TOP_SLOWEST = 20
+PERCENTILES = [50, 90, 99]
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, len(sorted_values) * percent // 100)
+    return sorted_values[index]
+
+def timing_stats(durations):
+    sorted_durations = sorted(durations)
+    stats = {
+        "calls": len(durations),
+        "total": round(sum(durations), 6)
+    }
+    if sorted_durations:
+        for percent in PERCENTILES:
+            stats[f"p{percent}"] = round(percentile(sorted_durations, percent), 6)
+        stats["max"] = round(sorted_durations[-1], 6)
+    return stats
+
+
+class ProcessorProfiler:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        # Processor name to the durations of its process calls
+        self.process_times = collections.defaultdict(list)
+        # Processor name to a heap of (duration, product id)
+        self.slowest = collections.defaultdict(list)
+        # Item name to the durations of its loads
+        self.load_times = collections.defaultdict(list)
+        self.finish_times = {}
+        # Processor name to the highest memory peak in bytes
+        self.memory_peaks = collections.defaultdict(int)
+
+    def start(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def num_workers(self, num_workers):
+        """Measured calls may not overlap, the tracemalloc peak is global"""
+        if self.enabled:
+            return 1
+        return num_workers
+
+    def begin_measure(self):
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return time.perf_counter(), start_memory
+
+    def end_measure(self, name, measure):
+        start_time, start_memory = measure
+        duration = time.perf_counter() - start_time
+        peak = tracemalloc.get_traced_memory()[1] - start_memory
+        self.memory_peaks[name] = max(self.memory_peaks[name], peak)
+        return duration
+
+    async def load(self, item_name, load_function, *args):
+        if not self.enabled:
+            return await load_function(*args)
+        start_time = time.perf_counter()
+        result = await load_function(*args)
+        self.load_times[item_name].append(time.perf_counter() - start_time)
+        return result
+
+    async def process(self, processor, processor_data):
+        if not self.enabled:
+            await processor.process(processor_data)
+            return
+        name = processor_name(processor)
+        measure = self.begin_measure()
+        await processor.process(processor_data)
+        duration = self.end_measure(name, measure)
+        self.process_times[name].append(duration)
+        slowest = self.slowest[name]
+        if len(slowest) < TOP_SLOWEST:
+            heapq.heappush(slowest, (duration, processor_data.id))
+        else:
+            heapq.heappushpop(slowest, (duration, processor_data.id))
+
+    async def finish(self, processor):
+        if not self.enabled:
+            await processor.finish()
+            return
+        name = processor_name(processor)
+        measure = self.begin_measure()
+        await processor.finish()
+        self.finish_times[name] = self.end_measure(name, measure)
+
+    def merge(self, other):
+        """Add the measurements of a profiler from a processor process"""
+        for name, durations in other.process_times.items():
+            self.process_times[name].extend(durations)
+        for name, slowest in other.slowest.items():
+            self.slowest[name] = heapq.nlargest(TOP_SLOWEST, self.slowest[name] + slowest)
+            heapq.heapify(self.slowest[name])
+        for item_name, durations in other.load_times.items():
+            self.load_times[item_name].extend(durations)
+        for name, peak in other.memory_peaks.items():
+            self.memory_peaks[name] = max(self.memory_peaks[name], peak)
+
+    def processor_names(self):
+        return sorted(set(self.process_times) | set(self.finish_times))
+
+    def processor_total(self, name):
+        return sum(self.process_times[name]) + self.finish_times.get(name, 0.0)
+
+    def to_json(self):
+        processors_json = {}
+        for name in self.processor_names():
+            processor_json = timing_stats(self.process_times[name])
+            processor_json["finish"] = round(self.finish_times.get(name, 0.0), 6)
+            processor_json["memory_peak"] = self.memory_peaks[name]
+            processor_json["slowest"] = [
+                [prod_id, round(duration, 6)]
+                for duration, prod_id in sorted(self.slowest[name], reverse=True)
+            ]
+            processors_json[name] = processor_json
+        return {
+            "processors": processors_json,
+            "loads": {
+                item_name: timing_stats(durations)
+                for item_name, durations in sorted(self.load_times.items())
+            }
+        }
+
+    def summary(self):
+        processor_parts = []
+        for name in sorted(self.processor_names(), key=self.processor_total, reverse=True):
+            total = self.processor_total(name)
+            peak_mib = self.memory_peaks[name] / 2**20
+            processor_parts.append(f"{name} {total:.1f}s/{peak_mib:.1f} MiB")
+        load_total = sum(sum(durations) for durations in self.load_times.values())
+        return (
+            f"Processor time and peak memory: {', '.join(processor_parts)}, "
+            f"loading {load_total:.1f}s, details in processor_profile.json"
+        )
@@ -0,0 +1,234 @@
+"""
+Adaptive request concurrency per host.
+
+Every host starts with a concurrency limit that grows by one for every limit
+successful requests and shrinks on errors, rate limiting and rising latency
+(additive increase, multiplicative decrease). After repeated failures a circuit
+breaker holds back all requests to the host for a cooldown and then lets a
+single probe request through to decide whether the host has recovered.
+"""
+
+import asyncio
+import datetime
+import email.utils
+import random
+import time
+import urllib.parse
+
+
+
+INITIAL_LIMIT = 10
+MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 64
+# Requests sent before a decrease would otherwise decrease the limit again
+DECREASE_INTERVAL = 1.0
+ERROR_DECREASE = 0.5
+LATENCY_DECREASE = 0.8
+# Smoothed latency above this multiple of the best smoothed latency counts as congestion
+LATENCY_FACTOR = 3.0
+LATENCY_ALPHA = 0.1
+# Consecutive failures that open the breaker
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 10.0
+BREAKER_MAX_COOLDOWN = 300.0
+MAX_RETRY_AFTER = 300.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+SUCCESS = "success"
+FAILURE = "failure"
+
+def host_group(url):
+    hostname = urllib.parse.urlsplit(url).hostname or ""
+    # Repositories and manifests are served from several cdn hostnames
+    if "cdn" in hostname:
+        return "cdn"
+    return hostname
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, which is either seconds or a date"""
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_date.tzinfo is None:
+            retry_date = retry_date.replace(tzinfo=datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        seconds = (retry_date - now).total_seconds()
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+def is_failure_status(status):
+    return status == 408 or status == 429 or status >= 500
+
+
+class HostController:
+    def __init__(self, name, max_limit=DEFAULT_MAX_LIMIT):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = float(min(INITIAL_LIMIT, max_limit))
+        self.in_flight = 0
+        self.changed = asyncio.Condition()
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.paused_until = 0.0
+        self.consecutive_failures = 0
+        # None while the breaker is closed
+        self.breaker_open_until = None
+        self.breaker_cooldown = BREAKER_COOLDOWN
+        self.probing = False
+        self.num_requests = 0
+        self.num_failures = 0
+        self.num_breaker_trips = 0
+        self.peak_limit = self.limit
+
+    def __repr__(self):
+        return f"HostController({self.name!r}, limit={self.limit:.1f}, in_flight={self.in_flight})"
+
+    def can_start(self, now):
+        if now < self.paused_until:
+            return False
+        if self.breaker_open_until is not None:
+            if now < self.breaker_open_until or self.probing:
+                return False
+            # Half open, a single probe once earlier requests have finished
+            return self.in_flight == 0
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        """Wait for a free slot, returns True if the request is the breaker probe"""
+        async with self.changed:
+            while True:
+                now = time.monotonic()
+                if self.can_start(now):
+                    break
+                wake_time = max(self.paused_until, self.breaker_open_until or 0.0)
+                timeout = wake_time - now if wake_time > now else None
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            is_probe = self.breaker_open_until is not None
+            if is_probe:
+                self.probing = True
+            self.in_flight += 1
+            self.num_requests += 1
+            return is_probe
+
+    async def release(self, slot):
+        async with self.changed:
+            now = time.monotonic()
+            at_limit = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if slot.is_probe:
+                self.probing = False
+            if slot.retry_after is not None:
+                self.paused_until = max(self.paused_until, now + slot.retry_after)
+            if slot.outcome == SUCCESS:
+                self.on_success(now, slot.latency, slot.is_probe, at_limit)
+            elif slot.outcome == FAILURE:
+                self.on_failure(now, slot.is_probe)
+            self.changed.notify_all()
+
+    def on_success(self, now, latency, is_probe, at_limit):
+        self.consecutive_failures = 0
+        if is_probe:
+            self.breaker_open_until = None
+            self.breaker_cooldown = BREAKER_COOLDOWN
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_ALPHA * (latency - self.latency)
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+            if self.latency > LATENCY_FACTOR * self.best_latency:
+                self.decrease(now, LATENCY_DECREASE)
+                return
+        # Only grow a limit that is actually used
+        if at_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+
+    def on_failure(self, now, is_probe):
+        self.num_failures += 1
+        self.consecutive_failures += 1
+        self.decrease(now, ERROR_DECREASE)
+        if is_probe:
+            self.breaker_cooldown = min(self.breaker_cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self.breaker_open_until = now + self.breaker_cooldown
+        elif self.breaker_open_until is None and self.consecutive_failures >= BREAKER_THRESHOLD:
+            self.num_breaker_trips += 1
+            self.breaker_open_until = now + self.breaker_cooldown
+
+    def decrease(self, now, factor):
+        if now - self.last_decrease >= DECREASE_INTERVAL:
+            self.limit = max(MIN_LIMIT, self.limit * factor)
+            self.last_decrease = now
+
+    def summary(self):
+        latency_ms = (self.latency or 0.0) * 1000
+        return (
+            f"{self.name}: {self.num_requests} requests, {self.num_failures} failures, "
+            f"limit {self.limit:.1f} (peak {self.peak_limit:.1f}), "
+            f"latency {latency_ms:.0f}ms, breaker tripped {self.num_breaker_trips} times"
+        )
+
+
+class RequestSlot:
+    """Holds a concurrency slot of a host for the duration of one request attempt"""
+    def __init__(self, host):
+        self.host = host
+        self.is_probe = False
+        self.start_time = None
+        self.outcome = None
+        self.latency = None
+        self.retry_after = None
+
+    async def __aenter__(self):
+        self.is_probe = await self.host.acquire()
+        self.start_time = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.host.release(self)
+        return False
+
+    def response(self, status, headers):
+        """Record the response status, latency is measured up to the response headers"""
+        self.latency = time.monotonic() - self.start_time
+        if is_failure_status(status):
+            self.outcome = FAILURE
+        else:
+            self.outcome = SUCCESS
+        if status == 429 or status == 503:
+            self.retry_after = parse_retry_after(headers.get("Retry-After"))
+
+    def failure(self):
+        self.outcome = FAILURE
+
+
+class RateControl:
+    def __init__(self, max_limit=DEFAULT_MAX_LIMIT):
+        self.max_limit = max_limit
+        self.hosts = {}
+
+    def slot(self, url):
+        name = host_group(url)
+        host = self.hosts.get(name)
+        if host is None:
+            host = HostController(name, self.max_limit)
+            self.hosts[name] = host
+        return RequestSlot(host)
+
+    def summary(self):
+        return [self.hosts[name].summary() for name in sorted(self.hosts)]
@@ -0,0 +1,113 @@
+"""
+Refresh intervals per product based on how active it is.
+
+Every product gets a tier when it is processed. Trending products, games in
+development and products with recent builds or changes are checked often,
+products without content rarely. A run only downloads products whose interval
+has passed, most overdue first, up to a maximum number per run. Products that
+were never processed are always downloaded.
+"""
+
+import random
+
+
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+TIER_INTERVALS = {
+    "hot": 4 * HOUR,
+    "active": DAY,
+    "listed": 3 * DAY,
+    "dormant": 14 * DAY,
+    "dead": 30 * DAY
+}
+# Spread products of the same tier over several runs
+INTERVAL_JITTER = 0.1
+TRENDING_TOP = 500
+RECENT_BUILD_AGE = 14 * DAY
+ACTIVE_BUILD_AGE = 365 * DAY
+# Changes per product count half as much after this many seconds
+CHANGE_HALF_LIFE = 7 * DAY
+HOT_CHANGE_SCORE = 1.0
+
+
+def last_build_time(prod):
+    build_dates = [build.date_published for build in prod.builds if build.date_published]
+    if not build_dates:
+        return None
+    return max(build_dates).timestamp()
+
+def product_tier(prod, change_score, now):
+    if prod is None or not prod.has_content():
+        return "dead"
+    build_time = last_build_time(prod)
+    build_age = now - build_time if build_time is not None else None
+    if (
+        prod.is_in_development
+        or (prod.rank_trending is not None and prod.rank_trending < TRENDING_TOP)
+        or (build_age is not None and build_age < RECENT_BUILD_AGE)
+        or change_score >= HOT_CHANGE_SCORE
+    ):
+        return "hot"
+    if prod.store_state:
+        if build_age is not None and build_age < ACTIVE_BUILD_AGE:
+            return "active"
+        return "listed"
+    return "dormant"
+
+
+class RefreshScheduler:
+    def __init__(self, state, max_products):
+        # Product id as string to [last check, interval, change score]
+        self.state = state or {}
+        self.max_products = max_products
+        self.selected = set()
+        self.tier_counts = {tier: 0 for tier in TIER_INTERVALS}
+
+    def plan(self, ids, now):
+        """Select the products due in this run, returns them most overdue first"""
+        overdue = []
+        for prod_id in ids:
+            entry = self.state.get(str(prod_id))
+            if entry is None:
+                continue
+            last_check, interval, change_score = entry
+            overdue_ratio = (now - last_check) / interval
+            if overdue_ratio >= 1:
+                overdue.append((overdue_ratio, prod_id))
+        overdue.sort(reverse=True)
+        due_ids = [prod_id for overdue_ratio, prod_id in overdue[:self.max_products]]
+        self.selected = set(due_ids)
+        return due_ids
+
+    def wants(self, prod_id):
+        return prod_id in self.selected or str(prod_id) not in self.state
+
+    def decayed_score(self, prod_id, num_changes, now):
+        entry = self.state.get(str(prod_id))
+        if entry is None:
+            return num_changes
+        last_check, interval, change_score = entry
+        return change_score * 0.5 ** ((now - last_check) / CHANGE_HALF_LIFE) + num_changes
+
+    def update(self, prod_id, prod, num_changes, now):
+        change_score = self.decayed_score(prod_id, num_changes, now)
+        self.set_tier(prod_id, product_tier(prod, change_score, now), change_score, now)
+
+    def update_not_found(self, prod_id, existed, now):
+        """
+        The product doesn't exist (anymore). Products that existed before are checked again
+        as dormant, in case they come back, products that never existed as dead.
+        """
+        tier = "dormant" if existed else "dead"
+        self.set_tier(prod_id, tier, self.decayed_score(prod_id, 0, now), now)
+
+    def set_tier(self, prod_id, tier, change_score, now):
+        self.tier_counts[tier] += 1
+        interval = TIER_INTERVALS[tier] * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER)
+        self.state[str(prod_id)] = [now, round(interval), round(change_score, 3)]
+
+    def summary(self):
+        tiers = ", ".join(f"{count} {tier}" for tier, count in self.tier_counts.items())
+        return f"Refreshed products by tier: {tiers}"
@@ -0,0 +1,379 @@
+"""
+Download with several processes, each responsible for a shard of the product IDs.
+
+A product belongs to the shard scramble_number(id) % N. The main process acts as
+coordinator: it owns the token and refreshes it for all shards, downloads the
+catalog and prices and keeps the list of known products. Shards download the
+products they are sent with their own session and storage. Products a shard
+discovers are reported to the coordinator, which sends new ones on to the shard
+owning them. Once the catalog is done and every shard has finished all products
+it was sent, the coordinator tells the shards that no more products follow.
+"""
+
+import asyncio
+import datetime
+import multiprocessing
+import queue
+import time
+import traceback
+
+import quart
+
+import gogdb.core.storage as storage
+from gogdb.core.codec import Codec
+from gogdb.updater.gogsession import GogSession
+from gogdb.updater.scheduler import RefreshScheduler
+from gogdb.updater.journal import DirtyJournal
+from gogdb.updater.updater import (
+    QueueManager, ManifestQueue, catalog_worker, product_worker, set_storedata,
+    recover_interrupted_run, mark_unknown_changes, scramble_number, wait_or_raise,
+    configure_logging, eprint, logger
+)
+
+
+
+# Shards get a new token this long before the old one expires
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+TOKEN_CHECK_INTERVAL = 30
+# Seconds between checks if the other processes are still alive
+RECEIVE_TIMEOUT = 1.0
+
+class ShardError(Exception):
+    pass
+
+def shard_of(prod_id, num_shards):
+    return scramble_number(prod_id) % num_shards
+
+def receive(message_queue):
+    """Blocking get for a worker thread, returns None after a timeout"""
+    try:
+        return message_queue.get(timeout=RECEIVE_TIMEOUT)
+    except queue.Empty:
+        return None
+
+
+class ShardQueueManager(QueueManager):
+    """Queues the products of one shard, all products discovered are reported to the coordinator"""
+    def __init__(self, shard_num, num_shards, outbox, scheduler=None):
+        super().__init__(scheduler)
+        self.shard_num = shard_num
+        self.num_shards = num_shards
+        self.outbox = outbox
+        self.reported_products = set()
+        # Batches of products received from the coordinator
+        self.num_batches = 0
+        self.batch_received = asyncio.Event()
+
+    def schedule_products(self, prod_ids):
+        new_ids = []
+        for prod_id in prod_ids:
+            if prod_id in self.scheduled_products or prod_id in self.reported_products:
+                continue
+            new_ids.append(prod_id)
+            if shard_of(prod_id, self.num_shards) == self.shard_num:
+                self.schedule_product(prod_id)
+            else:
+                self.reported_products.add(prod_id)
+        if new_ids:
+            self.outbox.put(("discovered", self.shard_num, new_ids))
+
+    def receive_products(self, prod_ids):
+        for prod_id in prod_ids:
+            self.schedule_product(prod_id)
+        self.num_batches += 1
+        self.batch_received.set()
+
+
+async def shard_inbox_worker(inbox, session, qman):
+    while True:
+        message = await asyncio.to_thread(receive, inbox)
+        if message is None:
+            if not multiprocessing.parent_process().is_alive():
+                raise ShardError("Coordinator process exited")
+            continue
+        kind = message[0]
+        if kind == "products":
+            qman.receive_products(message[1])
+        elif kind == "token":
+            session.set_shared_token(message[1])
+        elif kind == "exhausted":
+            qman.products_exhausted.set()
+        elif kind == "stop":
+            return
+
+async def shard_idle_worker(shard_num, outbox, qman):
+    """Reports the number of finished batches whenever the product queue runs empty"""
+    while True:
+        qman.batch_received.clear()
+        await qman.products_queue.join()
+        if qman.batch_received.is_set():
+            # Products of the new batch might not have been queued before the join finished
+            continue
+        outbox.put(("idle", shard_num, qman.num_batches))
+        await qman.batch_received.wait()
+
+async def shard_download(shard_num, num_shards, config_data, inbox, outbox, token_data, schedule):
+    config = quart.Config(".")
+    config.update(config_data)
+    configure_logging(config)
+    codec = Codec.from_config(config)
+    db = storage.Storage.from_config(config, codec=codec)
+    session = GogSession(db, config)
+    session.set_shared_token(token_data)
+
+    scheduler = None
+    if schedule is not None:
+        scheduler = RefreshScheduler(schedule["state"], config["SCHEDULE_MAX_PRODUCTS"])
+        scheduler.selected = set(schedule["selected"])
+    qman = ShardQueueManager(shard_num, num_shards, outbox, scheduler)
+    journal = DirtyJournal()
+    inbox_task = asyncio.create_task(shard_inbox_worker(inbox, session, qman))
+    idle_task = asyncio.create_task(shard_idle_worker(shard_num, outbox, qman))
+
+    num_product_tasks = config.get("NUM_PRODUCT_TASKS", 1)
+    logger.info(f"Shard {shard_num} creating {num_product_tasks} product workers")
+    manifest_queue = ManifestQueue(session, db, config.get("NUM_MANIFEST_TASKS", 16))
+    manifest_queue.start()
+    product_tasks = [
+        asyncio.create_task(product_worker(session, qman, db, i, manifest_queue, journal))
+        for i in range(num_product_tasks)
+    ]
+    # Workers finish after the coordinator signalled that no more products follow
+    products_task = asyncio.gather(*product_tasks, return_exceptions=False)
+    await wait_or_raise({products_task}, {*manifest_queue.worker_tasks, inbox_task, idle_task})
+    idle_task.cancel()
+    await manifest_queue.close()
+
+    # Printed by the coordinator, so lines of different shards don't get mixed up
+    summaries = [manifest_queue.summary()]
+    if session.revalidate:
+        summaries.append(f"{session.num_not_modified} responses were not modified")
+    summaries.extend(session.rate_control.summary())
+    result = {
+        "queued": len(qman.queued_products),
+        "summaries": summaries,
+        "journal": journal.to_json(),
+        "schedule": None,
+        "tier_counts": None
+    }
+    if scheduler is not None:
+        result["schedule"] = scheduler.state
+        result["tier_counts"] = scheduler.tier_counts
+    outbox.put(("done", shard_num, result))
+    # Keep receiving tokens until the coordinator lets the shard stop
+    await inbox_task
+
+    await session.close()
+    await asyncio.sleep(0.250) # Wait for aiohttp to close connections
+    await db.close()
+    codec.close()
+
+def shard_main(shard_num, num_shards, config_data, inbox, outbox, token_data, schedule):
+    """Entry point of a shard process"""
+    try:
+        asyncio.run(shard_download(
+            shard_num, num_shards, config_data, inbox, outbox, token_data, schedule))
+    except BaseException:
+        outbox.put(("error", shard_num, traceback.format_exc()))
+        raise
+
+
+class ShardCoordinator:
+    def __init__(self, num_shards):
+        self.num_shards = num_shards
+        # Shards only import the updater, a forked event loop would be unusable
+        self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        self.inboxes = [self.context.Queue() for shard_num in range(num_shards)]
+        self.processes = []
+        # All known products, used by catalog_worker like the QueueManager of a single process
+        self.scheduled_products = set()
+        self.num_sent = [0] * num_shards
+        self.num_idle = [None] * num_shards
+        self.results = [None] * num_shards
+        self.catalog_done = False
+        self.exhausted = False
+
+    def start(self, config, token_data, schedules):
+        for shard_num in range(self.num_shards):
+            process = self.context.Process(
+                target=shard_main,
+                name=f"updater-shard-{shard_num}",
+                args=(
+                    shard_num, self.num_shards, dict(config), self.inboxes[shard_num],
+                    self.outbox, token_data, schedules[shard_num]
+                )
+            )
+            process.start()
+            self.processes.append(process)
+
+    def schedule_products(self, prod_ids, source_shard=None):
+        """Send products not known yet to their shards, a shard already has the ones it reports"""
+        ids_by_shard = [[] for shard_num in range(self.num_shards)]
+        for prod_id in prod_ids:
+            if prod_id in self.scheduled_products:
+                continue
+            self.scheduled_products.add(prod_id)
+            shard_num = shard_of(prod_id, self.num_shards)
+            if shard_num != source_shard:
+                ids_by_shard[shard_num].append(prod_id)
+        for shard_num, shard_ids in enumerate(ids_by_shard):
+            if shard_ids:
+                self.inboxes[shard_num].put(("products", shard_ids))
+                self.num_sent[shard_num] += 1
+
+    def broadcast(self, message):
+        for inbox in self.inboxes:
+            inbox.put(message)
+
+    def finish_catalog(self):
+        self.catalog_done = True
+        self.check_exhausted()
+
+    def check_exhausted(self):
+        """
+        Discovered products are reported before a shard reports being idle, so if every
+        shard finished all batches sent to it, no more products can turn up.
+        """
+        if self.exhausted or not self.catalog_done:
+            return
+        if self.num_idle == self.num_sent:
+            self.exhausted = True
+            self.broadcast(("exhausted",))
+
+    def check_processes(self):
+        for shard_num, process in enumerate(self.processes):
+            if self.results[shard_num] is None and process.exitcode is not None:
+                raise ShardError(f"Shard {shard_num} exited with code {process.exitcode}")
+
+    async def receive_worker(self):
+        """Handle messages from the shards until all of them are done"""
+        while any(result is None for result in self.results):
+            message = await asyncio.to_thread(receive, self.outbox)
+            if message is None:
+                self.check_processes()
+                continue
+            kind, shard_num = message[0], message[1]
+            if kind == "discovered":
+                self.schedule_products(message[2], source_shard=shard_num)
+            elif kind == "idle":
+                self.num_idle[shard_num] = message[2]
+                self.check_exhausted()
+            elif kind == "done":
+                self.results[shard_num] = message[2]
+                self.inboxes[shard_num].put(("stop",))
+            elif kind == "error":
+                raise ShardError(f"Shard {shard_num} failed:\n{message[2]}")
+
+    async def token_worker(self, session):
+        while True:
+            await asyncio.sleep(TOKEN_CHECK_INTERVAL)
+            if await session.token.refresh_if_expired(margin=-TOKEN_REFRESH_MARGIN):
+                await session.save_token()
+                self.broadcast(("token", session.token.get_data()))
+
+    async def join(self):
+        for process in self.processes:
+            await asyncio.to_thread(process.join)
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        # Don't block on flushing messages nobody is going to read
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
+
+
+def split_schedule(scheduler, due_ids, num_shards):
+    schedules = [{"state": {}, "selected": []} for shard_num in range(num_shards)]
+    for prod_key, entry in scheduler.state.items():
+        schedules[shard_of(int(prod_key), num_shards)]["state"][prod_key] = entry
+    for prod_id in due_ids:
+        schedules[shard_of(prod_id, num_shards)]["selected"].append(prod_id)
+    return schedules
+
+def merge_schedules(scheduler, results):
+    for result in results:
+        scheduler.state.update(result["schedule"])
+        for tier, count in result["tier_counts"].items():
+            scheduler.tier_counts[tier] += count
+
+async def sharded_download_main(db, config, num_shards):
+    """Returns the journal of changed products of all shards"""
+    session = GogSession(db, config)
+    await session.load_token()
+    # Shards can't refresh the token themselves, start them with a fresh one
+    if await session.token.refresh_if_expired(margin=-TOKEN_REFRESH_MARGIN):
+        await session.save_token()
+
+    journal = DirtyJournal()
+    previous_checkpoint = await recover_interrupted_run(db, journal)
+    # Shards don't save checkpoints, this only tells the next run that one was interrupted
+    await db.checkpoint.save({"sharded": True})
+    ids = await db.ids.load()
+    if ids is None:
+        ids = []
+    ids.sort(key=scramble_number)
+    eprint(f"Starting downloader with {len(ids)} IDs in {num_shards} shards")
+    scheduler = None
+    due_ids = []
+    schedules = [None] * num_shards
+    if config.get("SCHEDULE_MAX_PRODUCTS") is not None:
+        scheduler = RefreshScheduler(await db.schedule.load(), config["SCHEDULE_MAX_PRODUCTS"])
+        due_ids = scheduler.plan(ids, time.time())
+        eprint(f"{len(due_ids)} products are due for a refresh")
+        schedules = split_schedule(scheduler, due_ids, num_shards)
+
+    num_storage_tasks = config.get("NUM_STORAGE_TASKS", 8)
+    coordinator = ShardCoordinator(num_shards)
+    coordinator.start(config, session.token.get_data(), schedules)
+    try:
+        # Queue the most overdue products first
+        coordinator.schedule_products(due_ids)
+        coordinator.schedule_products(ids)
+        if previous_checkpoint is not None:
+            # Including products only the interrupted run discovered
+            coordinator.schedule_products(previous_checkpoint["known"])
+        receive_task = asyncio.create_task(coordinator.receive_worker())
+        token_task = asyncio.create_task(coordinator.token_worker(session))
+        catalog_task = asyncio.create_task(
+            catalog_worker(session, coordinator, db, journal, num_storage_tasks))
+        await wait_or_raise({catalog_task}, {receive_task, token_task})
+        coordinator.finish_catalog()
+        await wait_or_raise({receive_task}, {token_task})
+        token_task.cancel()
+        await coordinator.join()
+    except BaseException:
+        coordinator.terminate()
+        raise
+
+    ids = list(coordinator.scheduled_products)
+    await db.ids.save(ids)
+    for result in coordinator.results:
+        journal.update_json(result["journal"])
+    if previous_checkpoint is not None:
+        mark_unknown_changes(journal, previous_checkpoint, ids)
+
+    catalog_results = catalog_task.result()
+    if catalog_results is not None:
+        logger.info("Setting catalog data")
+        await set_storedata(db, catalog_results, ids, journal, num_storage_tasks)
+    else:
+        logger.error("Not setting catalog data because of worker error")
+    for shard_num, result in enumerate(coordinator.results):
+        for summary in result["summaries"]:
+            eprint(f"Shard {shard_num}: {summary}")
+    num_queued = sum(result["queued"] for result in coordinator.results)
+    eprint(f"Requested {num_queued} of {len(ids)} products")
+    if scheduler is not None:
+        merge_schedules(scheduler, coordinator.results)
+        await db.schedule.save(scheduler.state)
+        eprint(scheduler.summary())
+
+    for host_summary in session.rate_control.summary():
+        eprint(host_summary)
+
+    await session.close()
+    await asyncio.sleep(0.250) # Wait for aiohttp to close connections
+    return journal
@@ -81,6 +81,12 @@ class StartpageProcessor:
             on_sale = on_sale_sort_val
         ))
 
+    def get_partial(self):
+        return self.summaries
+
+    async def merge(self, partial):
+        self.summaries.extend(partial)
+
     async def finish(self):
         games = [p for p in self.summaries if p.type == "game"]
         list_added = sorted(games, key=lambda p: p.added_on, reverse=True)[:NUM_SUMMARY]
@@ -1,8 +1,11 @@
 #!/usr/bin/python3
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
+import multiprocessing
 import datetime
-import copy
 import sys
 import decimal
 from dataclasses import dataclass
@@ -13,8 +16,12 @@ import quart
 
 import gogdb.core.model as model
 import gogdb.core.storage as storage
-from gogdb.core.changelogger import Changelogger
-from gogdb.updater.gogsession import GogSession
+from gogdb.core.changelogger import Changelogger, ProductSnapshot
+from gogdb.core.codec import Codec, LoopMonitor
+from gogdb.updater.gogsession import GogSession, is_not_modified, NOT_FOUND
+from gogdb.updater.scheduler import RefreshScheduler
+from gogdb.updater.journal import DirtyJournal, save_journal, load_changes, processor_name
+from gogdb.updater.profiler import ProcessorProfiler
 import gogdb.updater.dataextractors as dataextractors
 
 
@@ -24,6 +31,14 @@ logger = logging.getLogger("UpdateDB")
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+def configure_logging(config):
+    logging.basicConfig()
+    logger.setLevel(config.get("UPDATER_LOGLEVEL", logging.NOTSET))
+    logging.getLogger("UpdateDB.session").setLevel(config.get("SESSION_LOGLEVEL", logging.NOTSET))
+
+# Price updates of one batch share a transaction with the sqlite backend
+PRICE_BATCH_SIZE = 500
+
 def scramble_number(value):
     return (value * 16205650284070698839) & 0xFFFFFFFF
 
@@ -32,9 +47,13 @@ class QueueExhausted(Exception):
     pass
 
 class QueueManager:
-    def __init__(self):
+    def __init__(self, scheduler=None):
         self.products_queue = asyncio.Queue()
+        # All known products, including ones the scheduler doesn't want downloaded
         self.scheduled_products = set()
+        self.queued_products = set()
+        self.completed_products = set()
+        self.scheduler = scheduler
         # No more products may get added after this event is set
         self.products_exhausted = asyncio.Event()
 
@@ -42,7 +61,12 @@ class QueueManager:
         assert type(prod_id) is int
         if prod_id not in self.scheduled_products:
             self.scheduled_products.add(prod_id)
-            self.products_queue.put_nowait(prod_id)
+            if self.scheduler is None or self.scheduler.wants(prod_id):
+                self.queue_product(prod_id)
+
+    def queue_product(self, prod_id):
+        self.queued_products.add(prod_id)
+        self.products_queue.put_nowait(prod_id)
 
     def schedule_products(self, prod_ids):
         for prod_id in prod_ids:
@@ -68,9 +92,137 @@ class QueueManager:
         return await self._get_from_queue(
             self.products_queue, self.products_exhausted)
 
-    def products_done(self):
+    def products_done(self, prod_id):
+        self.completed_products.add(prod_id)
         self.products_queue.task_done()
 
+    def get_checkpoint(self):
+        # Products in progress are not completed and get downloaded again
+        pending = self.queued_products - self.completed_products
+        return {
+            "known": sorted(self.scheduled_products),
+            "pending": sorted(pending, key=scramble_number)
+        }
+
+    def restore_checkpoint(self, checkpoint):
+        self.scheduled_products.update(checkpoint["known"])
+        for prod_id in checkpoint["pending"]:
+            self.queue_product(prod_id)
+
+
+class ManifestQueue:
+    """
+    Downloads manifests with its own pool of workers. Every manifest is only queued once
+    per run, no matter how many builds and products reference it.
+    """
+    def __init__(self, session, db, num_workers):
+        self.session = session
+        self.db = db
+        self.num_workers = num_workers
+        self.queue = asyncio.Queue()
+        self.scheduled = set()
+        # (generation, manifest id) to link of manifests queued or in progress
+        self.pending = {}
+        self.worker_tasks = []
+        self.start_time = None
+        self.num_downloaded = 0
+        self.num_existing = 0
+        self.num_failed = 0
+        self.num_duplicates = 0
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.worker_tasks = [
+            asyncio.create_task(self.worker()) for worker_num in range(self.num_workers)
+        ]
+
+    def schedule(self, generation, mf_id, link):
+        if (generation, mf_id) in self.scheduled:
+            self.num_duplicates += 1
+            return
+        self.scheduled.add((generation, mf_id))
+        self.pending[(generation, mf_id)] = link
+        self.queue.put_nowait((generation, mf_id, link))
+
+    def schedule_v1(self, mf_id, mf_url):
+        self.schedule(1, mf_id, mf_url)
+
+    def schedule_v2(self, mf_id, build_link):
+        self.schedule(2, mf_id, build_link)
+
+    async def worker(self):
+        while True:
+            generation, mf_id, link = await self.queue.get()
+            await self.download(generation, mf_id, link)
+            del self.pending[(generation, mf_id)]
+            self.queue.task_done()
+
+    def get_checkpoint(self):
+        # Manifests in progress are downloaded again
+        return [[generation, mf_id, link] for (generation, mf_id), link in self.pending.items()]
+
+    def restore_checkpoint(self, pending):
+        for generation, mf_id, link in pending:
+            self.schedule(generation, mf_id, link)
+
+    async def download(self, generation, mf_id, link):
+        if generation == 1:
+            item = self.db.manifest_v1
+        else:
+            item = self.db.manifest_v2
+        if await item.has(mf_id):
+            logger.debug(f"Not redownloading manifest v{generation} {mf_id}")
+            self.num_existing += 1
+            return
+        if generation == 1:
+            manifest = await self.session.fetch_manifest_v1(mf_id, link)
+        else:
+            manifest = await self.session.fetch_manifest_v2(link, mf_id)
+        if manifest is None:
+            self.num_failed += 1
+            return
+        await item.save(manifest, mf_id)
+        self.num_downloaded += 1
+
+    async def close(self):
+        """Wait until all queued manifests are downloaded and stop the workers"""
+        join_task = asyncio.create_task(self.queue.join())
+        await wait_or_raise({join_task}, set(self.worker_tasks))
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+
+    def summary(self):
+        runtime = time.monotonic() - self.start_time
+        mib_received = self.session.bytes_received["manifest"] / 2**20
+        return (
+            f"Downloaded {self.num_downloaded} manifests ({mib_received:.1f} MiB) in {runtime:.1f}s, "
+            f"{self.num_downloaded / runtime:.1f} manifests/s, {mib_received / runtime:.2f} MiB/s, "
+            f"{self.num_existing} already stored, {self.num_duplicates} duplicates avoided, "
+            f"{self.num_failed} failed"
+        )
+
+
+class FreshProducts:
+    """
+    Products saved by the product workers in a fused run, handed on to the processors
+    instead of loading them again. At most max_products are kept to limit memory use.
+    """
+    def __init__(self, max_products):
+        self.max_products = max_products
+        self.products = {}
+        self.num_reused = 0
+
+    def put(self, prod_id, prod):
+        if prod_id in self.products or len(self.products) < self.max_products:
+            self.products[prod_id] = prod
+
+    def pop(self, prod_id):
+        prod = self.products.pop(prod_id, None)
+        if prod is not None:
+            self.num_reused += 1
+        return prod
+
 
 @model.defaultdataclass
 class CatalogEntry:
@@ -83,41 +235,88 @@ class CatalogEntry:
     pos_bestselling: int = 0 # This is only set after manually merging both results
     pos_trending: int = 0 # See above
 
+def catalog_entries(page, position):
+    entries = []
+    for cat_prod in page["products"]:
+        cat_entry = CatalogEntry()
+        cat_entry.id = int(cat_prod["id"])
+        if cat_prod["price"] is not None:
+            cat_entry.price_base = decimal.Decimal(cat_prod["price"]["baseMoney"]["amount"])
+            cat_entry.price_final = decimal.Decimal(cat_prod["price"]["finalMoney"]["amount"])
+        cat_entry.rating = cat_prod["reviewsRating"]
+        cat_entry.state = cat_prod["productState"]
+        cat_entry.position = position
+        position += 1
+        entries.append(cat_entry)
+    return entries
+
+async def fetch_catalog_page(session, params, page_num):
+    page = await session.fetch_catalog(params, page_num)
+    if page is not None:
+        logger.info("Downloaded store page %s", page_num)
+        await session.store_validators(page)
+    return page
+
 async def get_catalog(session, params, pagination_method="page"):
+    if pagination_method == "search_after":
+        return await get_catalog_sequential(session, params)
+    return await get_catalog_concurrent(session, params)
+
+async def get_catalog_sequential(session, params):
+    """Each page starts after the last product of the previous one"""
     current_page = 1
-    total_pages = 1
-    position = 0
     collected_products = []
     while True:
-        page = await session.fetch_catalog(params, current_page)
+        page = await fetch_catalog_page(session, params, current_page)
         if page is None:
             return
-        logger.info("Downloaded store page %s", current_page)
-        total_pages = page["pages"]
-        for cat_prod in page["products"]:
-            cat_entry = CatalogEntry()
-            cat_entry.id = int(cat_prod["id"])
-            if cat_prod["price"] is not None:
-                cat_entry.price_base = decimal.Decimal(cat_prod["price"]["baseMoney"]["amount"])
-                cat_entry.price_final = decimal.Decimal(cat_prod["price"]["finalMoney"]["amount"])
-            cat_entry.rating = cat_prod["reviewsRating"]
-            cat_entry.state = cat_prod["productState"]
-            cat_entry.position = position
-            position += 1
-            collected_products.append(cat_entry)
+        collected_products.extend(catalog_entries(page, len(collected_products)))
+        if not page["products"]:
+            break
         current_page += 1
-        if pagination_method == "search_after":
-            if not page["products"]:
-                break
-            params["searchAfter"] = page["products"][-1]["id"]
-        else:  # "page"
-            if current_page > total_pages:
-                break
-            params["page"] = current_page
+        params["searchAfter"] = page["products"][-1]["id"]
+
+    return collected_products
+
+async def get_catalog_concurrent(session, params):
+    """The first page tells the number of pages, the rest are fetched at once"""
+    first_page = await fetch_catalog_page(session, params, 1)
+    if first_page is None:
+        return
+    # The rate control limits how many of these are actually in flight
+    other_pages = await asyncio.gather(*[
+        fetch_catalog_page(session, dict(params, page=page_num), page_num)
+        for page_num in range(2, first_page["pages"] + 1)
+    ])
+    collected_products = []
+    for page in [first_page, *other_pages]:
+        if page is None:
+            return
+        collected_products.extend(catalog_entries(page, len(collected_products)))
 
     return collected_products
 
-async def catalog_worker(session, qman, db):
+def catalog_to_json(catalog_res):
+    """Only the fields needed by set_storedata"""
+    return [
+        {
+            "id": cat_entry.id,
+            "rating": cat_entry.rating,
+            "state": cat_entry.state,
+            "pos_bestselling": cat_entry.pos_bestselling,
+            "pos_trending": cat_entry.pos_trending
+        }
+        for cat_entry in catalog_res
+    ]
+
+def catalog_from_json(catalog_json):
+    return [CatalogEntry(**entry_json) for entry_json in catalog_json]
+
+async def resumed_catalog_worker(catalog_res):
+    """Catalog and prices were already done by the interrupted run"""
+    return catalog_res
+
+async def catalog_worker(session, qman, db, journal, num_price_tasks=8):
     default_params = {
         "order": "asc:externalProductId",
         "productType": "in:game,pack,dlc,extras",
@@ -131,16 +330,25 @@ async def catalog_worker(session, qman, db):
     trending_params = default_params.copy()
     trending_params["order"] = "desc:trending"
 
+    # The rankings don't depend on the id pass, fetch them alongside it
+    ranking_task = asyncio.gather(
+        get_catalog(session, bestselling_params),
+        get_catalog(session, trending_params)
+    )
     # Do a first pass sorted by id because bestselling moves around too much
     catalog_res = await get_catalog(session, default_params, pagination_method="search_after")
     if catalog_res is None:
         logger.error("Requesting catalog by product id failed, ending catalog worker")
+        ranking_task.cancel()
+        try:
+            await ranking_task
+        except asyncio.CancelledError:
+            pass
         return
     catalog_ids = [cat_entry.id for cat_entry in catalog_res]
     qman.schedule_products(catalog_ids)
 
-    bestselling_res = await get_catalog(session, bestselling_params)
-    trending_res = await get_catalog(session, trending_params)
+    bestselling_res, trending_res = await ranking_task
     ranking_success = True
     if bestselling_res is None:
         logger.error("Requesting catalog by bestselling failed")
@@ -164,40 +372,73 @@ async def catalog_worker(session, qman, db):
     now = datetime.datetime.now(datetime.timezone.utc)
     all_ids = qman.scheduled_products.copy()
     entries_by_id = {cat_entry.id: cat_entry for cat_entry in catalog_res}
-    for prod_id in all_ids:
-        # Get catalog entry and update price
-        cat_entry = entries_by_id.get(prod_id)
-        if cat_entry is not None:
-            await update_price(
-                db,
-                prod_id = prod_id,
-                country = "US",
-                currency = "USD",
-                price_base = cat_entry.price_base,
-                price_final = cat_entry.price_final,
-                now = now
-            )
-        else:
-            await update_price(
-                db,
-                prod_id = prod_id,
-                country = "US",
-                currency = "USD",
-                price_base = None,
-                price_final = None,
-                now = now
-            )
+    start_time = time.monotonic()
+    num_changed = await update_prices(db, entries_by_id, all_ids, now, num_price_tasks, journal)
+    eprint(
+        f"Changed {num_changed} price records of {len(all_ids)} products "
+        f"in {time.monotonic() - start_time:.1f}s"
+    )
 
     if ranking_success:
         return merged_res
     else:
         return None
 
-async def update_price(db, prod_id, country, currency, price_base, price_final, now):
-    price_log = await db.prices.load(prod_id)
-    if price_log is None:
-        price_log = {"US": {"USD": []}}
-    currency_log = price_log["US"]["USD"]
+async def update_prices(db, entries_by_id, prod_ids, now, num_tasks, journal):
+    """Returns the number of changed price records"""
+    prod_ids = list(prod_ids)
+    num_changed = 0
+    # The product workers keep writing on the main connection while prices are updated
+    async with db.separate_connection() as price_db:
+        for batch_start in range(0, len(prod_ids), PRICE_BATCH_SIZE):
+            batch_ids = prod_ids[batch_start:batch_start + PRICE_BATCH_SIZE]
+            changes = []
+            worker_tasks = [
+                asyncio.create_task(
+                    price_worker(price_db, entries_by_id, batch_ids, now, changes))
+                for worker_num in range(num_tasks)
+            ]
+            await asyncio.gather(*worker_tasks, return_exceptions=False)
+            # Only the writes are batched, so the write lock is held briefly
+            async with price_db.write_batch():
+                for prod_id, change in changes:
+                    await apply_price_change(price_db, prod_id, change)
+                    journal.mark(prod_id, "prices")
+            num_changed += len(changes)
+    return num_changed
+
+async def price_worker(db, entries_by_id, ids, now, changes):
+    while ids:
+        prod_id = ids.pop()
+        # Products missing from the catalog are not for sale
+        cat_entry = entries_by_id.get(prod_id)
+        if cat_entry is not None:
+            price_base = cat_entry.price_base
+            price_final = cat_entry.price_final
+        else:
+            price_base = None
+            price_final = None
+        change = await price_change(
+            db,
+            prod_id = prod_id,
+            country = "US",
+            currency = "USD",
+            price_base = price_base,
+            price_final = price_final,
+            now = now
+        )
+        if change is not None:
+            changes.append((prod_id, change))
+
+async def price_change(db, prod_id, country, currency, price_base, price_final, now):
+    """
+    Returns the change to the price log without writing it, either ("pop", country, currency)
+    to remove the last record, ("append", country, record) or None
+    """
+    # Only the last two records are needed to detect changes and rollbacks
+    currency_log = await db.prices.load_tail(country, currency, 2, prod_id)
+    if currency_log is None:
+        currency_log = []
 
     record = model.PriceRecord(
         currency = currency,
@@ -219,18 +460,62 @@ async def update_price(db, prod_id, country, currency, price_base, price_final,
         if is_rollback:
             # Remove the last not-for-sale entry
             logger.warning(f"Price rollback for {prod_id}")
-            currency_log.pop()
+            return ("pop", country, currency)
         elif not record.same_price(last_price):
-            currency_log.append(record)
+            return ("append", country, record)
+    # Only start a log once the product is for sale
     elif record.price_base is not None:
-        currency_log.append(record)
+        return ("append", country, record)
+    return None
+
+async def apply_price_change(db, prod_id, change):
+    action, country, value = change
+    if action == "pop":
+        await db.prices.pop_record(country, value, prod_id)
+    else:
+        await db.prices.append_record(country, value, prod_id)
 
-    # Only save if it has entries
-    if price_log["US"]["USD"]:
-        await db.prices.save(price_log, prod_id)
 
+async def fetch_all_builds(session, prod_id, systems):
+    """Fetch the builds of all systems in parallel, returns them by system"""
+    builds_conts = await asyncio.gather(
+        *[session.fetch_builds(prod_id, system) for system in systems])
+    return dict(zip(systems, builds_conts))
 
-async def product_worker(session, qman, db, worker_number):
+async def fetch_repository(session, db, prod, build, journal):
+    repo = await db.repository.load(prod.id, build.id)
+    if repo is None:
+        if build.generation == 1:
+            repo = await session.fetch_repo_v1(build.link, prod.id, build.id)
+        else:
+            repo = await session.fetch_repo_v2(build.link, prod.id, build.id)
+        if repo is None:
+            return None
+        await db.repository.save(repo, prod.id, build.id)
+        journal.mark(prod.id, "repositories")
+    return repo
+
+async def download_repositories(session, db, prod, manifest_queue, journal):
+    """
+    Download missing repositories of all builds in parallel and queue their manifests
+    """
+    repos = await asyncio.gather(
+        *[fetch_repository(session, db, prod, build, journal) for build in prod.builds])
+    for build, repo in zip(prod.builds, repos):
+        if repo is None:
+            continue
+        if build.generation == 1:
+            for depot in repo["product"]["depots"]:
+                if "manifest" not in depot:
+                    continue
+                mf_id = depot["manifest"].split(".")[0]
+                mf_url = build.link.rsplit("/", 1)[0] + "/" + depot["manifest"]
+                manifest_queue.schedule_v1(mf_id, mf_url)
+        else:
+            for depot in repo["depots"] + [repo["offlineDepot"]]:
+                manifest_queue.schedule_v2(depot["manifest"], build.link)
+
+async def product_worker(session, qman, db, worker_number, manifest_queue, journal, fresh_products=None):
     while True:
         try:
             prod_id = await qman.get_from_products()
@@ -246,27 +531,48 @@ async def product_worker(session, qman, db, worker_number):
             prod.added_on = timestamp
             old_prod = None
         else:
-            old_prod = copy.deepcopy(prod)
+            old_prod = ProductSnapshot(prod)
 
-        changelog = await db.changelog.load(prod_id)
-        if changelog is None:
-            changelog = []
-        old_changelog_len = len(changelog)
         prod_changelogger = Changelogger(prod, old_prod, timestamp)
 
-        prod.access = 0
-
         v0_cont = await session.fetch_product_v0(prod_id)
+        # Unlike a failed request, a 404 means there is nothing to retry soon
+        is_not_found = v0_cont is NOT_FOUND
+        if is_not_found:
+            v0_cont = None
         # Basic sanity check
         has_v0 = v0_cont and "id" in v0_cont
+        responses = [v0_cont]
+        builds_conts = {}
+        is_unchanged = False
         if has_v0:
+            v2_cont = await session.fetch_product_v2(prod_id)
+            if v2_cont is NOT_FOUND:
+                v2_cont = None
+            has_v2 = v2_cont and "_embedded" in v2_cont
+            responses.append(v2_cont)
+            # Responses that were not modified have already been extracted into the stored
+            # product, if all of them are unchanged the product is as well
+            if old_prod is not None and is_not_modified(v0_cont, v2_cont):
+                builds_conts = await fetch_all_builds(session, prod_id, prod.cs_systems)
+                is_unchanged = is_not_modified(*builds_conts.values())
+
+        if is_unchanged:
+            logger.debug(f"Product {prod_id} not modified")
+            qman.schedule_products(prod.dlcs)
+            if has_v2:
+                qman.schedule_products(
+                    prod.includes_games + prod.is_included_in +
+                    prod.required_by + prod.requires)
+        else:
+            prod.access = 0
+
+        if has_v0 and not is_unchanged:
             dataextractors.extract_properties_v0(prod, v0_cont)
             prod.access = 1
             # Add referenced dlc to queue
             qman.schedule_products(prod.dlcs)
 
-            v2_cont = await session.fetch_product_v2(prod_id)
-            has_v2 = v2_cont and "_embedded" in v2_cont
             if has_v2:
                 dataextractors.extract_properties_v2(prod, v2_cont)
                 prod.access = 2
@@ -275,49 +581,21 @@ async def product_worker(session, qman, db, worker_number):
                     prod.includes_games + prod.is_included_in +
                     prod.required_by + prod.requires)
 
+            missing_systems = [system for system in prod.cs_systems if system not in builds_conts]
+            builds_conts.update(await fetch_all_builds(session, prod_id, missing_systems))
+            # Extract in a fixed order, independent of which download finished first
             for system in prod.cs_systems:
-                builds_cont = await session.fetch_builds(prod_id, system)
+                builds_cont = builds_conts[system]
                 if not builds_cont:
                     continue
 
                 dataextractors.extract_builds(prod, builds_cont, system)
 
-            for build in prod.builds:
-                repo = await db.repository.load(prod.id, build.id)
-                if build.generation == 1:
-                    if repo is None:
-                        repo = await session.fetch_repo_v1(build.link, prod.id, build.id)
-                        if repo is None:
-                            continue
-                        await db.repository.save(repo, prod.id, build.id)
-                    for depot in repo["product"]["depots"]:
-                        if "manifest" not in depot:
-                            continue
-                        mf_id = depot["manifest"].split(".")[0]
-                        mf_url = build.link.rsplit("/", 1)[0] + "/" + depot["manifest"]
-                        if not await db.manifest_v1.has(mf_id):
-                            manifest = await session.fetch_manifest_v1(mf_id, mf_url)
-                            if manifest is None:
-                                continue
-                            await db.manifest_v1.save(manifest, mf_id)
-                        else:
-                            logger.debug(f"Not redownloading manifest v1 {mf_id}")
-                else:
-                    if repo is None:
-                        repo = await session.fetch_repo_v2(build.link, prod.id, build.id)
-                        if repo is None:
-                            continue
-                        await db.repository.save(repo, prod.id, build.id)
-                    for depot in repo["depots"] + [repo["offlineDepot"]]:
-                        mf_id = depot["manifest"]
-                        if not await db.manifest_v2.has(mf_id):
-                            manifest = await session.fetch_manifest_v2(build.link, mf_id)
-                            if manifest is None:
-                                continue
-                            await db.manifest_v2.save(manifest, mf_id)
-                        else:
-                            logger.debug(f"Not redownloading manifest v2 {mf_id}")
+        if has_v0:
+            # Also for unchanged products, to retry repositories and manifests that failed
+            await download_repositories(session, db, prod, manifest_queue, journal)
 
+        if has_v0 and not is_unchanged:
             prod.last_updated = timestamp
 
             if old_prod:
@@ -334,6 +612,17 @@ async def product_worker(session, qman, db, worker_number):
                 prod_changelogger.builds()
 
 
+        # A failed request keeps the previous entry, so the product stays due
+        if qman.scheduler is not None and has_v0:
+            qman.scheduler.update(
+                prod_id, prod, len(prod_changelogger.entries), timestamp.timestamp())
+        elif qman.scheduler is not None and is_not_found:
+            qman.scheduler.update_not_found(prod_id, old_prod is not None, timestamp.timestamp())
+
+        if is_unchanged:
+            qman.products_done(prod_id)
+            continue
+
         if prod.has_content():
             if old_prod:
                 # Disabled because it can't be detected reliably
@@ -341,37 +630,108 @@ async def product_worker(session, qman, db, worker_number):
                 pass
             else:
                 prod_changelogger.prod_added()
-        changelog += prod_changelogger.entries
 
         if prod.has_content():
             await db.product.save(prod, prod.id)
+            journal.mark(prod_id, "product")
+            if fresh_products is not None:
+                fresh_products.put(prod_id, prod)
 
-        if len(changelog) != old_changelog_len:
-            await db.changelog.save(changelog, prod.id)
+        await db.changelog.append(prod_changelogger.entries, prod.id)
+        if prod_changelogger.entries:
+            journal.mark(prod_id, "changelog")
+        # Only after saving, a later 304 means the stored product is up to date
+        await session.store_validators(*responses, *builds_conts.values())
 
-        qman.products_queue.task_done()
+        qman.products_done(prod_id)
     logger.info(f"Worker {worker_number} done")
 
 
-async def set_storedata(db, catalog_res, all_ids):
-    num_entries = len(catalog_res)
+async def set_storedata(db, catalog_res, all_ids, journal, num_tasks=8):
     catalog_by_id = {cat_entry.id: cat_entry for cat_entry in catalog_res}
-    for prod_id in all_ids:
+    ids = list(all_ids)
+    # Nothing else writes at this point, so all changes can go into one batch
+    async with db.write_batch():
+        worker_tasks = [
+            asyncio.create_task(storedata_worker(db, catalog_by_id, ids, journal))
+            for worker_num in range(num_tasks)
+        ]
+        num_touched = sum(await asyncio.gather(*worker_tasks, return_exceptions=False))
+    logger.info(f"Catalog data changed for {num_touched} of {len(all_ids)} products")
+
+async def storedata_worker(db, catalog_by_id, ids, journal):
+    num_touched = 0
+    while ids:
+        prod_id = ids.pop()
         prod = await db.product.load(prod_id)
         if not prod:
             continue
-        cat_entry = catalog_by_id.get(prod_id)
-        if cat_entry:
-            prod.user_rating = cat_entry.rating
-            prod.store_state = cat_entry.state
-            prod.rank_bestselling = cat_entry.pos_bestselling
-            prod.rank_trending = cat_entry.pos_trending
-        else:
-            prod.user_rating = None
-            prod.store_state = None
-            prod.rank_bestselling = None
-            prod.rank_trending = None
-        await db.product.save(prod, prod_id)
+        if await apply_storedata(db, prod_id, prod, catalog_by_id, journal):
+            num_touched += 1
+    return num_touched
+
+async def apply_storedata(db, prod_id, prod, catalog_by_id, journal):
+    """Returns True if the catalog data of the product changed"""
+    cat_entry = catalog_by_id.get(prod_id)
+    if cat_entry:
+        storedata = (
+            cat_entry.rating, cat_entry.state,
+            cat_entry.pos_bestselling, cat_entry.pos_trending
+        )
+    else:
+        storedata = (None, None, None, None)
+    current_storedata = (
+        prod.user_rating, prod.store_state,
+        prod.rank_bestselling, prod.rank_trending
+    )
+    if storedata == current_storedata:
+        return False
+    prod.user_rating, prod.store_state, prod.rank_bestselling, prod.rank_trending = storedata
+    await db.product.save(prod, prod_id)
+    journal.mark(prod_id, "product")
+    return True
+
+async def fused_storedata(
+        db, catalog_res, all_ids, journal, processors, fresh_products, profiler, num_tasks=8):
+    """
+    Sets the catalog data and runs the prepared processors on the final products in the
+    same pass. Without catalog results only the processors run.
+    """
+    catalog_by_id = None
+    if catalog_res is not None:
+        catalog_by_id = {cat_entry.id: cat_entry for cat_entry in catalog_res}
+    ids = list(all_ids)
+    profiler.start()
+    async with db.write_batch():
+        worker_tasks = [
+            asyncio.create_task(fused_worker(
+                db, catalog_by_id, ids, journal, processors, fresh_products, profiler))
+            for worker_num in range(profiler.num_workers(num_tasks))
+        ]
+        num_touched = sum(await asyncio.gather(*worker_tasks, return_exceptions=False))
+    logger.info(f"Catalog data changed for {num_touched} of {len(all_ids)} products")
+    eprint(f"Processed {len(all_ids)} products, {fresh_products.num_reused} of them without reloading")
+
+async def fused_worker(db, catalog_by_id, ids, journal, processors, fresh_products, profiler):
+    wants = set.union(*[processor.wants for processor in processors])
+    num_touched = 0
+    while ids:
+        prod_id = ids.pop()
+        prod = fresh_products.pop(prod_id)
+        if prod is None:
+            prod = await profiler.load("product", db.product.load, prod_id)
+        if prod and catalog_by_id is not None:
+            if await apply_storedata(db, prod_id, prod, catalog_by_id, journal):
+                num_touched += 1
+        processor_data = ProcessorData(id=prod_id, product=prod)
+        if "changelog" in wants:
+            processor_data.changelog = await profiler.load("changelog", db.changelog.load, prod_id)
+        if "prices" in wants:
+            processor_data.prices = await profiler.load("prices", db.prices.load, prod_id)
+        add_item_caches(processor_data, db, processors, profiler)
+        for processor in processors:
+            await profiler.process(processor, processor_data)
+    return num_touched
 
 
 async def wait_or_raise(waiting, raising):
@@ -393,28 +753,169 @@ async def wait_or_raise(waiting, raising):
         if done_waiting:
             return done_waiting
 
-async def download_main(db, config):
+async def save_checkpoint(db, qman, manifest_queue, catalog_task, journal, storedata_started=False):
+    checkpoint = qman.get_checkpoint()
+    # Completed products can still have queued manifests, which have to be saved with them
+    checkpoint["manifests"] = manifest_queue.get_checkpoint()
+    checkpoint["journal"] = journal.to_json()
+    checkpoint["catalog_done"] = catalog_task.done() and catalog_task.exception() is None
+    checkpoint["storedata_started"] = storedata_started
+    checkpoint["catalog"] = None
+    if checkpoint["catalog_done"] and catalog_task.result() is not None:
+        checkpoint["catalog"] = catalog_to_json(catalog_task.result())
+    if qman.scheduler is not None:
+        checkpoint["schedule"] = qman.scheduler.state
+    await db.checkpoint.save(checkpoint)
+
+def mark_resumed_changes(journal, checkpoint):
+    """
+    Writes made after the checkpoint aren't in its journal and won't be detected again,
+    the items they might have changed are marked instead
+    """
+    for prod_id in checkpoint["pending"]:
+        journal.mark(prod_id, "product")
+        journal.mark(prod_id, "changelog")
+        journal.mark(prod_id, "repositories")
+    if not checkpoint["catalog_done"]:
+        for prod_id in checkpoint["known"]:
+            journal.mark(prod_id, "prices")
+    if checkpoint.get("storedata_started", False):
+        for prod_id in checkpoint["known"]:
+            journal.mark(prod_id, "product")
+
+def mark_unknown_changes(journal, checkpoint, queued_ids):
+    """
+    Products discovered after the checkpoint might have been written by the interrupted run
+    as well, mark the ones this run downloaded
+    """
+    known_ids = set(checkpoint["known"])
+    for prod_id in queued_ids:
+        if prod_id not in known_ids:
+            journal.mark(prod_id, "product")
+            journal.mark(prod_id, "changelog")
+            journal.mark(prod_id, "repositories")
+
+async def recover_interrupted_run(db, journal):
+    """
+    Keeps the changes of an interrupted run that isn't resumed. Returns its checkpoint,
+    None if there was none or it can't be used.
+    """
+    checkpoint = await db.checkpoint.load()
+    if checkpoint is None:
+        return None
+    if checkpoint.get("sharded", False):
+        # Sharded runs don't save their journal, so nothing is known about what they wrote
+        await db.processed.remove()
+        eprint("Found an interrupted sharded run, the next processing run rebuilds everything")
+        return None
+    journal.update_json(checkpoint.get("journal", {}))
+    mark_resumed_changes(journal, checkpoint)
+    eprint("Found an interrupted run, keeping its changes")
+    return checkpoint
+
+async def checkpoint_worker(db, qman, manifest_queue, catalog_task, journal, interval):
+    while True:
+        await asyncio.sleep(interval)
+        await save_checkpoint(db, qman, manifest_queue, catalog_task, journal)
+        logger.info(
+            f"Saved checkpoint, {len(qman.completed_products)} of "
+            f"{len(qman.queued_products)} products done"
+        )
+
+async def download_main(db, config, resume=False, processors=None, profiler=None):
+    """
+    Returns the journal of changed products. Prepared processors are run on the
+    products while setting the catalog data, but not finished.
+    """
+    loop_monitor = LoopMonitor()
+    loop_monitor.start()
     session = GogSession(db, config)
     await session.load_token()
-    qman = QueueManager()
-
-    ids = await db.ids.load()
-    if ids is None:
-        ids = []
-    ids.sort(key=scramble_number)
-    eprint(f"Starting downloader with {len(ids)} IDs")
-    qman.schedule_products(ids)
 
-    catalog_task = asyncio.create_task(catalog_worker(session, qman, db))
+    checkpoint = None
+    if resume:
+        checkpoint = await db.checkpoint.load()
+        if checkpoint is None:
+            eprint("No checkpoint found, starting a new run")
+        elif checkpoint.get("sharded", False):
+            eprint("Sharded runs can't be resumed, starting a new run")
+            checkpoint = None
+
+    scheduler = None
+    journal = DirtyJournal()
+    # Checkpoint of the interrupted run, if any
+    previous_checkpoint = checkpoint
+    if checkpoint is not None:
+        journal.update_json(checkpoint.get("journal", {}))
+        mark_resumed_changes(journal, checkpoint)
+        eprint(
+            f"Resuming with {len(checkpoint['pending'])} of {len(checkpoint['known'])} IDs "
+            f"left to download"
+        )
+        if config.get("SCHEDULE_MAX_PRODUCTS") is not None:
+            scheduler = RefreshScheduler(
+                checkpoint.get("schedule"), config["SCHEDULE_MAX_PRODUCTS"])
+            scheduler.selected = set(checkpoint["pending"])
+        qman = QueueManager(scheduler)
+        qman.restore_checkpoint(checkpoint)
+    else:
+        previous_checkpoint = await recover_interrupted_run(db, journal)
+        ids = await db.ids.load()
+        if ids is None:
+            ids = []
+        ids.sort(key=scramble_number)
+        eprint(f"Starting downloader with {len(ids)} IDs")
+        if config.get("SCHEDULE_MAX_PRODUCTS") is not None:
+            scheduler = RefreshScheduler(await db.schedule.load(), config["SCHEDULE_MAX_PRODUCTS"])
+            due_ids = scheduler.plan(ids, time.time())
+            eprint(f"{len(due_ids)} products are due for a refresh")
+        qman = QueueManager(scheduler)
+        if scheduler is not None:
+            # Queue the most overdue products first
+            qman.schedule_products(due_ids)
+        qman.schedule_products(ids)
+        if previous_checkpoint is not None:
+            # Including products only the interrupted run discovered
+            qman.schedule_products(previous_checkpoint["known"])
+
+    # Concurrency of the price and catalog data stages, which only do storage I/O
+    num_storage_tasks = config.get("NUM_STORAGE_TASKS", 8)
+    if checkpoint is not None and checkpoint["catalog_done"]:
+        catalog_res = checkpoint["catalog"]
+        if catalog_res is not None:
+            catalog_res = catalog_from_json(catalog_res)
+        catalog_task = asyncio.create_task(resumed_catalog_worker(catalog_res))
+    else:
+        catalog_task = asyncio.create_task(
+            catalog_worker(session, qman, db, journal, num_storage_tasks))
     num_product_tasks = config.get("NUM_PRODUCT_TASKS", 1)
     logger.info(f"Creating {num_product_tasks} product workers")
+    manifest_queue = ManifestQueue(session, db, config.get("NUM_MANIFEST_TASKS", 16))
+    if checkpoint is not None:
+        manifest_queue.restore_checkpoint(checkpoint.get("manifests", []))
+    manifest_queue.start()
+    fresh_products = None
+    if processors:
+        fresh_products = FreshProducts(config.get("FUSED_MAX_PRODUCTS", 5000))
     product_tasks = [
-        asyncio.create_task(product_worker(session, qman, db, i))
+        asyncio.create_task(
+            product_worker(session, qman, db, i, manifest_queue, journal, fresh_products))
         for i in range(num_product_tasks)
     ]
-    await wait_or_raise({catalog_task}, {*product_tasks})
+    checkpoint_task = asyncio.create_task(checkpoint_worker(
+        db, qman, manifest_queue, catalog_task, journal, config.get("CHECKPOINT_INTERVAL", 120)))
+    await wait_or_raise(
+        {catalog_task}, {*product_tasks, *manifest_queue.worker_tasks, checkpoint_task})
     qman.products_exhausted.set()
-    await asyncio.gather(*product_tasks, return_exceptions=False)
+    products_task = asyncio.gather(*product_tasks, return_exceptions=False)
+    await wait_or_raise({products_task}, {*manifest_queue.worker_tasks, checkpoint_task})
+    await manifest_queue.close()
+    eprint(manifest_queue.summary())
+    checkpoint_task.cancel()
+    if previous_checkpoint is not None:
+        mark_unknown_changes(journal, previous_checkpoint, qman.queued_products)
+    # Everything but the catalog data is done at this point
+    await save_checkpoint(db, qman, manifest_queue, catalog_task, journal, storedata_started=True)
 
     ids = list(qman.scheduled_products)
     await db.ids.save(ids)
@@ -422,13 +923,48 @@ async def download_main(db, config):
     catalog_results = catalog_task.result()
     if catalog_results is not None:
         logger.info("Setting catalog data")
-        await set_storedata(db, catalog_results, ids)
     else:
         logger.error("Not setting catalog data because of worker error")
-    eprint(f"Requested {len(ids)} products")
+    if processors:
+        await fused_storedata(
+            db, catalog_results, ids, journal, processors, fresh_products, profiler,
+            num_storage_tasks)
+    elif catalog_results is not None:
+        await set_storedata(db, catalog_results, ids, journal, num_storage_tasks)
+    eprint(f"Requested {len(qman.queued_products)} of {len(ids)} products")
+    if scheduler is not None:
+        await db.schedule.save(scheduler.state)
+        eprint(scheduler.summary())
+    if session.revalidate:
+        eprint(f"{session.num_not_modified} responses were not modified")
+
+    for host_summary in session.rate_control.summary():
+        eprint(host_summary)
 
     await session.close()
     await asyncio.sleep(0.250) # Wait for aiohttp to close connections
+    await loop_monitor.stop()
+    eprint(loop_monitor.summary())
+    logger.info(f"Codec stats: {db.codec}")
+    return journal
+
+class ItemCache:
+    """
+    Loads the items of a product on first access. Items are kept for the other
+    processors if more than one of them wants them.
+    """
+    def __init__(self, load_function, keep):
+        self.load_function = load_function
+        self.keep = keep
+        self.items = {}
+
+    async def load(self, *args):
+        if args in self.items:
+            return self.items[args]
+        item = await self.load_function(*args)
+        if self.keep:
+            self.items[args] = item
+        return item
 
 @dataclass
 class ProcessorData:
@@ -436,53 +972,170 @@ class ProcessorData:
     product: model.Product = None
     changelog: List[model.ChangeRecord] = None
     prices: List[model.PriceRecord] = None
-
-async def processor_worker(db, ids, processors, worker_num):
-    wants = set.union(*[processor.wants for processor in processors])
+    repositories: ItemCache = None
+    manifests: ItemCache = None
+
+def add_item_caches(processor_data, db, processors, profiler):
+    """Lets the processors share the repositories and manifests they load"""
+    num_wanted = collections.Counter(
+        item for processor in processors for item in processor.wants)
+    if num_wanted["repositories"]:
+        processor_data.repositories = ItemCache(
+            functools.partial(profiler.load, "repository", db.repository.load, processor_data.id),
+            keep=num_wanted["repositories"] > 1)
+    if num_wanted["manifests"]:
+        processor_data.manifests = ItemCache(
+            functools.partial(profiler.load, "manifest", db.manifest_v2.load),
+            keep=num_wanted["manifests"] > 1)
+
+async def processor_worker(db, ids, processors, selections, profiler, worker_num):
     while ids:
         prod_id = ids.pop()
+        # Processors in incremental mode only get the products that changed
+        active_processors = [
+            processor for processor, selection in zip(processors, selections)
+            if selection is None or prod_id in selection
+        ]
+        if not active_processors:
+            continue
+        wants = set.union(*[processor.wants for processor in active_processors])
         logger.info(f"Worker {worker_num} processing {prod_id}")
         processor_data = ProcessorData(id=prod_id)
         if "product" in wants:
-            processor_data.product = await db.product.load(prod_id)
+            processor_data.product = await profiler.load("product", db.product.load, prod_id)
         if "changelog" in wants:
-            processor_data.changelog = await db.changelog.load(prod_id)
+            processor_data.changelog = await profiler.load("changelog", db.changelog.load, prod_id)
         if "prices" in wants:
-            processor_data.prices = await db.prices.load(prod_id)
-        for processor in processors:
-            await processor.process(processor_data)
+            processor_data.prices = await profiler.load("prices", db.prices.load, prod_id)
+        add_item_caches(processor_data, db, active_processors, profiler)
+        for processor in active_processors:
+            await profiler.process(processor, processor_data)
 
-async def processors_main(db, processors):
-    ids = await db.ids.load()
-
-    for processor in processors:
-        await processor.prepare()
+async def run_processor_workers(db, ids, processors, selections, profiler):
     worker_tasks = [
-        asyncio.create_task(processor_worker(db, ids, processors, worker_num))
-        for worker_num in range(8)
+        asyncio.create_task(
+            processor_worker(db, ids, processors, selections, profiler, worker_num))
+        for worker_num in range(profiler.num_workers(8))
     ]
     await asyncio.gather(*worker_tasks, return_exceptions=False)
-    for processor in processors:
-        await processor.finish()
 
-async def main():
-    config = quart.Config(".")
-    config.from_envvar("GOGDB_CONFIG")
-    db = storage.Storage(config["STORAGE_PATH"])
+def is_mergeable(processor):
+    return hasattr(processor, "merge")
 
-    logging.basicConfig()
-    logger.setLevel(config.get("UPDATER_LOGLEVEL", logging.NOTSET))
-    logging.getLogger("UpdateDB.session").setLevel(config.get("SESSION_LOGLEVEL", logging.NOTSET))
-
-    start_time = time.monotonic()
+async def processor_shard(config_data, tasks, ids, selections, profile):
+    config = quart.Config(".")
+    config.update(config_data)
+    configure_logging(config)
+    codec = Codec.from_config(config)
+    db = storage.Storage.from_config(config, codec=codec)
+    # Worker copies of the processors are never prepared or finished
+    processors = [
+        processor for processor in create_processors(db, tasks) if is_mergeable(processor)
+    ]
+    profiler = ProcessorProfiler(profile)
+    profiler.start()
+    await run_processor_workers(db, ids, processors, selections, profiler)
+    profiler.stop()
+    partials = [processor.get_partial() for processor in processors]
+    await db.close()
+    codec.close()
+    return partials, profiler
+
+def processor_shard_main(config_data, tasks, ids, selections, profile):
+    """
+    Entry point of a processor process, returns the partial state of each processor
+    and the profiler
+    """
+    return asyncio.run(processor_shard(config_data, tasks, ids, selections, profile))
+
+async def run_processor_shards(config, tasks, ids, selections, num_processes, profile):
+    # Scrambled so every process gets a similar mix of products
+    ids = sorted(ids, key=scramble_number)
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ProcessPoolExecutor(
+            num_processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return await asyncio.gather(*[
+            loop.run_in_executor(
+                pool, processor_shard_main, dict(config), tasks,
+                ids[shard_num::num_processes], selections, profile)
+            for shard_num in range(num_processes)
+        ])
+
+async def prepare_processors(db, processors, incremental):
+    """
+    Prepares all processors, returns the current generation and for every processor
+    the IDs of the products it has to process, None for all of them
+    """
+    generation = await db.generation.load() or 0
+    processed = await db.processed.load() or {}
+    selections = []
+    for processor in processors:
+        name = processor_name(processor)
+        since_generation = processed.get(name)
+        selection = None
+        if incremental and hasattr(processor, "incremental") and since_generation is not None:
+            changes = await load_changes(db, since_generation, generation)
+            if changes is not None:
+                changed_ids = changes.ids_with(processor.incremental)
+                # Fails if the previous output is missing
+                if await processor.prepare_incremental(changed_ids):
+                    selection = changed_ids
+        if selection is None:
+            await processor.prepare()
+            eprint(f"{name}: processing all products")
+        else:
+            eprint(f"{name}: processing {len(selection)} changed products")
+        selections.append(selection)
+    return generation, selections
+
+async def processors_main(db, processors, config, tasks, incremental=False, profile=False):
+    generation, selections = await prepare_processors(db, processors, incremental)
+    if any(selection is None for selection in selections):
+        ids = await db.ids.load()
+    else:
+        ids = list(set().union(*selections))
+    num_processes = config.get("PROCESSOR_PROCESSES", 0)
+
+    local_processors = []
+    local_selections = []
+    merged_processors = []
+    merged_selections = []
+    for processor, selection in zip(processors, selections):
+        if num_processes > 0 and is_mergeable(processor):
+            merged_processors.append(processor)
+            merged_selections.append(selection)
+        else:
+            local_processors.append(processor)
+            local_selections.append(selection)
+    profiler = ProcessorProfiler(profile)
+    profiler.start()
+    if merged_processors:
+        shards_task = asyncio.create_task(run_processor_shards(
+            config, tasks, ids, merged_selections, num_processes, profile))
+    if local_processors:
+        await run_processor_workers(db, list(ids), local_processors, local_selections, profiler)
+    if merged_processors:
+        for partials, shard_profiler in await shards_task:
+            for processor, partial in zip(merged_processors, partials):
+                await processor.merge(partial)
+            profiler.merge(shard_profiler)
+    await finish_processors(db, processors, generation, profiler)
+
+async def finish_processors(db, processors, generation, profiler):
+    """Finishes all processors and records the generation they processed"""
+    for processor in processors:
+        await profiler.finish(processor)
+    if profiler.enabled:
+        profiler.stop()
+        await db.processor_profile.save(profiler.to_json())
+        eprint(profiler.summary())
 
-    tasks = sys.argv[1:]
-    if not tasks:
-        eprint("Updater missing task argument: [all, download, index, startpage, charts, versions, dependencies, backref, filelist]")
-        exit(1)
-    if "all" in tasks:
-        tasks = ["download", "index", "startpage", "charts", "versions"]
+    processed = await db.processed.load() or {}
+    for processor in processors:
+        processed[processor_name(processor)] = generation
+    await db.processed.save(processed)
 
+def create_processors(db, tasks):
     processors = []
     if "index" in tasks:
         from gogdb.updater.indexdb import IndexDbProcessor
@@ -508,14 +1161,84 @@ async def main():
     if "idmapping" in tasks:
         from gogdb.updater.idmapping import IdMappingProcessor
         processors.append(IdMappingProcessor(db))
+    return processors
+
+async def main():
+    config = quart.Config(".")
+    config.from_envvar("GOGDB_CONFIG")
+    codec = Codec.from_config(config)
+    db = storage.Storage.from_config(config, codec=codec)
+
+    configure_logging(config)
+
+    start_time = time.monotonic()
+
+    tasks = sys.argv[1:]
+    # Continue an interrupted download from its last checkpoint
+    resume = "--resume" in tasks
+    # Only process products changed since the last run of each processor
+    incremental = "--incremental" in tasks
+    # Process the products while downloading instead of loading them again afterwards
+    fused = "--fused" in tasks
+    # Time the processors and save a report to processor_profile.json
+    profile = "--profile" in tasks
+    tasks = [
+        task for task in tasks
+        if task not in ("--resume", "--incremental", "--fused", "--profile")
+    ]
+    # Download with this many processes
+    num_shards = 1
+    if "--shards" in tasks:
+        shards_pos = tasks.index("--shards")
+        num_shards = int(tasks[shards_pos + 1])
+        del tasks[shards_pos:shards_pos + 2]
+    if not tasks:
+        eprint("Updater missing task argument: [all, download, index, startpage, charts, versions, dependencies, backref, filelist] [--resume] [--shards N] [--incremental] [--fused] [--profile]")
+        exit(1)
+    if resume and num_shards > 1:
+        eprint("--resume can't be combined with --shards")
+        exit(1)
+    if "all" in tasks:
+        tasks = ["download", "index", "startpage", "charts", "versions"]
+
+    processors = create_processors(db, tasks)
+    if fused and ("download" not in tasks or not processors):
+        eprint("--fused needs the download and at least one processing task")
+        exit(1)
+    if fused and num_shards > 1:
+        eprint("--fused can't be combined with --shards")
+        exit(1)
+    if fused:
+        profiler = ProcessorProfiler(profile)
+        if incremental or config.get("PROCESSOR_PROCESSES", 0) > 0:
+            eprint("Fused runs process all products in the main process")
+        await prepare_processors(db, processors, incremental=False)
 
     if "download" in tasks:
-        await download_main(db, config)
+        if num_shards > 1:
+            from gogdb.updater.shards import sharded_download_main
+            journal = await sharded_download_main(db, config, num_shards)
+        else:
+            if fused:
+                journal = await download_main(db, config, resume, processors, profiler)
+            else:
+                journal = await download_main(db, config, resume)
+        generation = await db.bump_generation()
+        await save_journal(db, journal, generation)
+        # The next run recovers the changes from the checkpoint until the journal is saved
+        await db.checkpoint.remove()
+        eprint(f"{len(journal)} products changed")
 
-    if processors:
-        await processors_main(db, processors)
+    if fused:
+        await finish_processors(db, processors, generation, profiler)
+    elif processors:
+        await processors_main(db, processors, config, tasks, incremental, profile)
+
+    await db.close()
+    codec.close()
 
     runtime_min = (time.monotonic() - start_time) / 60
     eprint(f"Took {runtime_min:.2f} minutes")
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
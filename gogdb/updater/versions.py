@@ -108,6 +108,7 @@ def compare_version(a, b):
 
 class VersionsProcessor:
     wants = {"product"}
+    incremental = {"product"}
 
     def __init__(self, db):
         self.db = db
@@ -118,6 +119,13 @@ class VersionsProcessor:
     async def prepare(self):
         pass
 
+    async def prepare_incremental(self, ids):
+        mismatches = await self.db.versions.load()
+        if mismatches is None:
+            return False
+        self.mismatches = [mismatch for mismatch in mismatches if mismatch.id not in ids]
+        return True
+
     async def process(self, data):
         prod = data.product
         if prod is None:
@@ -162,6 +170,14 @@ class VersionsProcessor:
                         ))
 
 
+    def get_partial(self):
+        return (self.mismatches, self.issues)
+
+    async def merge(self, partial):
+        mismatches, issues = partial
+        self.mismatches.extend(mismatches)
+        self.issues.extend(issues)
+
     async def finish(self):
         self.mismatches.sort(key=lambda m: m.build_published, reverse=True)
         await self.db.versions.save(self.mismatches)
@@ -47,7 +47,8 @@ async def product_info(prod_id):
         pricehistory = await storagedb.prices.load(prod_id)
         has_old_prices = False
     if pricehistory:
-        cur_history = pricehistory["US"]["USD"]
+        # Copy because the loaded prices may be shared with other requests
+        cur_history = list(pricehistory["US"]["USD"])
     else:
         cur_history = []
     changelog = await storagedb.changelog.load(prod_id)
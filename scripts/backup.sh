@@ -20,5 +20,11 @@ find . -name 'gogdb_*' -printf '%P\n' | sort > "$products_path/filelist.txt"
 mkdir -p "$BACKUP_PATH/manifests"
 cd "$STORAGE_PATH"
 echo "Compressing manifests"
-tar --create --file "$BACKUP_PATH/manifests/manifests_current.tar" "manifests_v1" "manifests_v2"
+manifest_dirs=""
+for manifest_dir in "manifests_v1" "manifests_v2" "packs"; do
+    if [ -e "$manifest_dir" ]; then
+        manifest_dirs="$manifest_dirs $manifest_dir"
+    fi
+done
+tar --create --file "$BACKUP_PATH/manifests/manifests_current.tar" --exclude "packs/*/lock" $manifest_dirs
 
@@ -25,7 +25,25 @@ exporter)
 cleanup)
     python3 gogdb/tools/cleanup.py "$@"
     ;;
+packs)
+    python3 gogdb/tools/packs.py "$@"
+    ;;
+backend)
+    python3 gogdb/tools/backend.py "$@"
+    ;;
+changelogs)
+    python3 gogdb/tools/changelogs.py "$@"
+    ;;
+manifestindex)
+    python3 gogdb/tools/manifestindex.py "$@"
+    ;;
+pricelogs)
+    python3 gogdb/tools/pricelogs.py "$@"
+    ;;
+benchmark)
+    python3 gogdb/tools/benchmark.py "$@"
+    ;;
 *)
-    echo "Missing script name [web, updater, token, exporter, cleanup]"
+    echo "Missing script name [web, updater, token, exporter, cleanup, packs, backend, changelogs, pricelogs, manifestindex, benchmark]"
     ;;
 esac